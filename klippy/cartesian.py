@@ -60,6 +60,15 @@ class CartKinematics:
             # Set final homed position
             coord[axis] = s.position_endstop + s.get_homed_offset()*s.step_dist
             homing_state.set_homed_position(coord)
+    def set_homed(self, axes):
+        # Treat the given axes as homed at their current position
+        for axis in axes:
+            s = self.steppers[axis]
+            self.limits[axis] = (s.position_min, s.position_max)
+    def get_homed_position(self):
+        return [s.position_endstop for s in self.steppers]
+    def get_max_z(self):
+        return self.steppers[2].position_max
     def motor_off(self, move_time):
         self.limits = [(1.0, -1.0)] * 3
         for stepper in self.steppers:
@@ -7,7 +7,8 @@ import os, logging
 import cffi
 
 COMPILE_CMD = "gcc -Wall -g -O -shared -fPIC -o %s %s"
-SOURCE_FILES = ['stepcompress.c', 'serialqueue.c', 'pyhelper.c']
+SOURCE_FILES = ['stepcompress.c', 'serialqueue.c', 'lookahead.c',
+                'pyhelper.c']
 DEST_LIB = "c_helper.so"
 OTHER_FILES = ['list.h', 'serialqueue.h', 'pyhelper.h']
 
@@ -62,15 +63,29 @@ defs_serialqueue = """
     void serialqueue_encode_and_send(struct serialqueue *sq
         , struct command_queue *cq, uint32_t *data, int len
         , uint64_t min_clock, uint64_t req_clock);
+    void serialqueue_send_urgent(struct serialqueue *sq, uint8_t *msg
+        , int len);
     void serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm);
     void serialqueue_set_baud_adjust(struct serialqueue *sq, double baud_adjust);
     void serialqueue_set_clock_est(struct serialqueue *sq, double est_clock
         , double last_ack_time, uint64_t last_ack_clock);
+    void serialqueue_get_urgent_times(struct serialqueue *sq, double *times);
+    double serialqueue_get_idle_time(struct serialqueue *sq);
     void serialqueue_get_stats(struct serialqueue *sq, char *buf, int len);
     int serialqueue_extract_old(struct serialqueue *sq, int sentq
         , struct pull_queue_message *q, int max);
 """
 
+defs_lookahead = """
+    struct lookahead *lookahead_alloc(void);
+    void lookahead_free(struct lookahead *la);
+    void lookahead_reset(struct lookahead *la);
+    void lookahead_add(struct lookahead *la, double junction_max
+        , double junction_delta, double junction_start_max);
+    int lookahead_flush(struct lookahead *la, int lazy, double **move_info);
+    void lookahead_get_stats(struct lookahead *la, char *buf, int len);
+"""
+
 defs_pyhelper = """
     void set_python_logging_callback(void (*func)(const char *));
 """
@@ -110,6 +125,7 @@ def get_ffi():
         FFI_main = cffi.FFI()
         FFI_main.cdef(defs_stepcompress)
         FFI_main.cdef(defs_serialqueue)
+        FFI_main.cdef(defs_lookahead)
         FFI_main.cdef(defs_pyhelper)
         FFI_lib = FFI_main.dlopen(os.path.join(srcdir, DEST_LIB))
         # Setup error logging
@@ -99,6 +99,14 @@ class DeltaKinematics:
                  * s.step_dist
                  for s in self.steppers]
         homing_state.set_homed_position(self._actuator_to_cartesian(coord))
+    def set_homed(self, axes):
+        # Treat the towers as homed at their current position
+        self.limit_xy2 = self.max_xy2
+    def get_homed_position(self):
+        return [0., 0., self.steppers[0].position_endstop]
+    def get_max_z(self):
+        # Highest position that is reachable at any XY position
+        return self.limit_z
     def motor_off(self, move_time):
         self.limit_xy2 = -1.
         for stepper in self.steppers:
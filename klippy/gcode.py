@@ -3,12 +3,20 @@
 # Copyright (C) 2016  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, re, logging, collections, time
-import homing
+import os, re, logging, collections, time, math
+import homing, gcodefile, gcodecache, gcodeworker, gcodeindex
+
+# Arcs with an angle smaller than this (in radians) are full circles
+ARC_EPSILON = 0.0000005
+# Height (in mm) the nozzle is raised above the print while resuming
+RESUME_Z_CLEARANCE = 5.
 
 # Parse out incoming GCode and find and translate head movements
 class GCodeParser:
     RETRY_TIME = 0.100
+    READ_SIZE = 4096
+    MAX_READ_SIZE = 65536
+    HOLD_INPUT_LINES = 64
     def __init__(self, printer, fd, is_fileinput=False):
         self.printer = printer
         self.fd = fd
@@ -17,24 +25,72 @@ class GCodeParser:
         self.reactor = printer.reactor
         self.is_processing_data = False
         self.fd_handle = None
+        self.input_file = self.file_timer = None
+        self.input_cache = self.cache_dir = None
+        self.worker = self.worker_handle = None
+        self.input_decoder = None
+        self.resume_state = None
+        self.recorder = None
         if not is_fileinput:
             self.fd_handle = self.reactor.register_fd(self.fd, self.process_data)
-        self.input_commands = [""]
+        else:
+            self.input_file = gcodefile.open_gcode_file(self.fd)
+        self.next_progress_report = 0.
+        self.input_commands = collections.deque()
+        self.partial_input = ""
+        self.read_size = self.min_read_size = self.READ_SIZE
+        self.max_read_size = self.MAX_READ_SIZE
         self.bytes_read = 0
         self.input_log = collections.deque([], 50)
+        self.lines_processed = self.last_stats_lines = 0
+        self.process_time = self.last_stats_process_time = 0.
+        # Response buffering
+        self.output_buffer = []
+        self.output_timer = self.reactor.register_timer(self.flush_output)
+        self.output_writes = self.output_acks = 0
+        self.output_callback = None
+        self.ack_ahead_limit = self.acked_ahead = 0
+        # Scripts submitted by other interfaces (eg, the job api)
+        self.scripts = collections.deque()
+        self.script_timer = self.reactor.register_timer(self.process_scripts)
+        self.input_held = False
+        # Emergency stop latency measurement
+        self.estop_time = 0.
+        self.estop_timer = self.reactor.register_timer(self.report_estop)
         # Command handling
         self.gcode_handlers = {}
         self.is_printer_ready = False
         self.need_ack = False
         self.toolhead = self.heater_nozzle = self.heater_bed = self.fan = None
+        self.fan_speed = 0.
+        self.defer_heater_wait = False
+        self.pending_heaters = []
         self.speed = 25.0
+        self.arc_tolerance = 0.01
         self.absolutecoord = self.absoluteextrude = True
         self.base_position = [0.0, 0.0, 0.0, 0.0]
         self.last_position = [0.0, 0.0, 0.0, 0.0]
         self.homing_add = [0.0, 0.0, 0.0, 0.0]
         self.axis2pos = {'X': 0, 'Y': 1, 'Z': 2, 'E': 3}
         self.build_handlers()
-    def build_config(self):
+    def build_config(self, config):
+        self.read_size = self.min_read_size = config.getint(
+            'gcode_read_size', self.READ_SIZE)
+        self.max_read_size = max(self.min_read_size, config.getint(
+            'gcode_max_read_size', self.MAX_READ_SIZE))
+        if not self.is_fileinput:
+            self.ack_ahead_limit = config.getint('gcode_ack_ahead', 0)
+        self.defer_heater_wait = config.getboolean(
+            'gcode_defer_heater_wait', False)
+        self.arc_tolerance = config.getfloat('arc_tolerance', 0.01)
+        if self.arc_tolerance <= 0.:
+            raise config.error("arc_tolerance must be greater than zero")
+        if config.getboolean('gcode_worker', False):
+            if self.recorder is not None:
+                # Recording needs the raw input seen by the reactor
+                logging.info("G-Code worker disabled while recording")
+            elif self.cache_dir is None:
+                self.start_worker()
         self.toolhead = self.printer.objects['toolhead']
         self.heater_nozzle = None
         extruder = self.printer.objects.get('extruder')
@@ -43,7 +99,7 @@ class GCodeParser:
         self.heater_bed = self.printer.objects.get('heater_bed')
         self.fan = self.printer.objects.get('fan')
     def build_handlers(self):
-        handlers = ['G1', 'G4', 'G20', 'G21', 'G28', 'G90', 'G91', 'G92',
+        handlers = ['G1', 'G2', 'G3', 'G4', 'G20', 'G21', 'G28', 'G90', 'G91', 'G92',
                     'M18', 'M82', 'M83', 'M105', 'M110', 'M112', 'M114', 'M115',
                     'M206', 'M400',
                     'HELP', 'QUERY_ENDSTOPS', 'RESTART', 'CLEAR_SHUTDOWN',
@@ -63,14 +119,155 @@ class GCodeParser:
             aliases = getattr(self, 'cmd_'+h+'_aliases', [])
             self.gcode_handlers.update(dict([(a, f) for a in aliases]))
     def stats(self, eventtime):
-        return "gcodein=%d" % (self.bytes_read,)
+        lines = self.lines_processed - self.last_stats_lines
+        process_time = self.process_time - self.last_stats_process_time
+        self.last_stats_lines = self.lines_processed
+        self.last_stats_process_time = self.process_time
+        lines_per_sec = 0.
+        if process_time > 0.:
+            lines_per_sec = lines / process_time
+        res = ("gcodein=%d gcode_lines=%d gcode_lines_per_sec=%.0f"
+               " gcode_acks=%d gcode_writes=%d" % (
+                   self.bytes_read, self.lines_processed, lines_per_sec,
+                   self.output_acks, self.output_writes))
+        if self.input_cache is not None:
+            res += " gcodein_progress=%.1f%%" % (
+                self.input_cache.get_progress() * 100.,)
+        elif self.input_file is not None:
+            res += " gcodein_progress=%.1f%%" % (
+                self.input_file.get_progress() * 100.,)
+        decoder = self.input_decoder
+        if decoder is None and self.input_file is not None:
+            decoder = self.input_file.decoder
+        if decoder is not None and decoder.bytes_in:
+            res += " " + decoder.get_stats()
+        return res
+    def get_status(self, eventtime):
+        return {'lines_processed': self.lines_processed,
+                'position': list(self.last_position),
+                'speed': self.speed * 60.}
+    def set_cache_dir(self, cache_dir):
+        self.cache_dir = cache_dir
+    def set_recorder(self, recorder):
+        self.recorder = recorder
+    def start_worker(self):
+        # Hand input reading and tokenizing to a separate process
+        if self.fd_handle is not None:
+            self.reactor.unregister_fd(self.fd_handle)
+            self.fd_handle = None
+        self.worker = gcodeworker.GCodeWorker(
+            self.fd, self.input_file, self.is_fileinput, self.partial_input,
+            self.input_decoder)
+        self.partial_input = ""
+        if not self.is_fileinput:
+            self.worker_handle = self.reactor.register_fd(
+                self.worker.note_fd, self.process_worker)
+    def set_resume(self, filename, line=None, layer=None):
+        # Start the input file part way through (using the file's index
+        # to find the position and the state to restore)
+        if self.input_file is None or self.input_file.decoder is not None:
+            raise gcodeindex.error(
+                "Resuming requires an uncompressed G-Code file")
+        index = gcodeindex.open_index(self.input_file, filename)
+        offset, line, state = index.locate(self.input_file, line, layer)
+        logging.info("Resuming G-Code file at line %d (offset %d)" % (
+            line, offset))
+        self.input_file.seek(offset)
+        # The cache can only replay a file from the start
+        self.cache_dir = None
+        self.resume_state = state
+    def disconnect(self):
+        if self.worker is not None:
+            self.worker.close()
+            self.worker = None
     def set_printer_ready(self, is_ready):
         if self.is_printer_ready == is_ready:
             return
         self.is_printer_ready = is_ready
         self.build_handlers()
-        if is_ready and self.is_fileinput and self.fd_handle is None:
+        if not is_ready or not self.is_fileinput:
+            return
+        if self.resume_state is not None:
+            self.is_processing_data = True
+            self.resume_print(self.resume_state)
+            self.is_processing_data = False
+            self.resume_state = None
+        if self.worker is not None:
+            if self.worker_handle is None:
+                self.worker_handle = self.reactor.register_fd(
+                    self.worker.note_fd, self.process_worker)
+        elif self.input_file is not None:
+            if self.file_timer is not None:
+                return
+            callback = self.process_file
+            if self.cache_dir is not None:
+                self.input_cache = gcodecache.open_cache(
+                    self.input_file, self.cache_dir)
+                callback = self.process_cache
+            self.file_timer = self.reactor.register_timer(
+                callback, self.reactor.NOW)
+        elif self.fd_handle is None:
             self.fd_handle = self.reactor.register_fd(self.fd, self.process_data)
+    def resume_print(self, state):
+        # Restore heaters and fan, raise the nozzle clear of the print,
+        # and home the X and Y axes.  The Z axis is assumed to still be
+        # where the print stopped unless the kinematics home it along
+        # with X and Y.
+        script = []
+        if self.heater_bed is not None and state.bed_temp:
+            script.append("M140 S%.3f" % (state.bed_temp,))
+        if self.heater_nozzle is not None and state.extruder_temp:
+            script.append("M104 S%.3f" % (state.extruder_temp,))
+        if self.heater_bed is not None and state.bed_temp:
+            script.append("M190 S%.3f" % (state.bed_temp,))
+        if self.heater_nozzle is not None and state.extruder_temp:
+            script.append("M109 S%.3f" % (state.extruder_temp,))
+        if self.fan is not None and state.fan_speed:
+            script.append("M106 S%.0f" % (state.fan_speed * 255.,))
+        for line in script:
+            self.process_line(line)
+        kin = self.toolhead.kin
+        last_z = state.last_position[2]
+        clear_z = max(last_z, min(last_z + RESUME_Z_CLEARANCE,
+                                  kin.get_max_z()))
+        travel_speed = self.toolhead.max_speed
+        pos = list(state.last_position)
+        self.toolhead.set_position(pos)
+        kin.set_homed([2])
+        try:
+            pos[2] = clear_z
+            self.toolhead.move(pos, travel_speed)
+        except homing.EndstopError, e:
+            logging.error("Unable to resume G-Code file: %s" % (e,))
+            self.respond_error(str(e))
+            self.input_file.seek(self.input_file.size)
+            return
+        homed_axes = self.home_axes([0, 1])
+        if not homed_axes:
+            # Homing failed - don't run the rest of the file
+            logging.error("Unable to resume G-Code file: homing failed")
+            self.input_file.seek(self.input_file.size)
+            return
+        # Travel to the position where the print stopped above the
+        # print and then lower the nozzle
+        pos = self.toolhead.get_position()
+        try:
+            pos[:3] = [state.last_position[0], state.last_position[1],
+                       clear_z]
+            self.toolhead.move(pos, travel_speed)
+            pos[2] = last_z
+            self.toolhead.move(pos, travel_speed)
+        except homing.EndstopError, e:
+            logging.error("Unable to resume G-Code file: %s" % (e,))
+            self.respond_error(str(e))
+            self.input_file.seek(self.input_file.size)
+            return
+        self.absolutecoord = state.absolutecoord
+        self.absoluteextrude = state.absoluteextrude
+        self.base_position = list(state.base_position)
+        self.last_position = list(state.last_position)
+        self.homing_add = list(state.homing_add)
+        self.speed = state.speed
     def motor_heater_off(self):
         if self.toolhead is not None:
             self.toolhead.motor_off()
@@ -86,72 +283,382 @@ class GCodeParser:
     # Parse input into commands
     args_r = re.compile('([a-zA-Z_]+|[a-zA-Z*])')
     def process_commands(self, eventtime):
-        while len(self.input_commands) > 1:
-            line = self.input_commands.pop(0)
-            # Ignore comments and leading/trailing spaces
-            line = origline = line.strip()
-            cpos = line.find(';')
-            if cpos >= 0:
-                line = line[:cpos]
-            # Break command into parts
-            parts = self.args_r.split(line)[1:]
-            params = dict((parts[i].upper(), parts[i+1].strip())
-                          for i in range(0, len(parts), 2))
-            params['#original'] = origline
-            if parts and parts[0].upper() == 'N':
-                # Skip line number at start of command
-                del parts[:2]
-            if not parts:
-                self.cmd_default(params)
-                continue
-            params['#command'] = cmd = parts[0].upper() + parts[1].strip()
-            # Invoke handler for command
-            self.need_ack = True
-            handler = self.gcode_handlers.get(cmd, self.cmd_default)
-            try:
-                handler(params)
-            except:
-                logging.exception("Exception in command handler")
-                self.toolhead.force_shutdown()
-                self.respond_error('Internal error on command:"%s"' % (cmd,))
-            self.ack()
+        starttime = time.time()
+        self.process_input_commands()
+        self.process_time += time.time() - starttime
+    def process_input_commands(self):
+        while self.input_commands:
+            if self.ack_ahead_limit and not self.acked_ahead:
+                self.ack_ahead()
+            line = self.input_commands.popleft()
+            if self.acked_ahead:
+                # This line was already acknowledged by ack_ahead()
+                self.acked_ahead -= 1
+                self.process_line(line, need_ack=False)
+            else:
+                self.process_line(line)
+    def ack_ahead(self):
+        # Acknowledge simple moves as soon as they are queued so that
+        # the sender does not wait on moves that are stalled in the
+        # toolhead.  Acks must be sent in order, so stop at the first
+        # line that must run before it can be acknowledged.
+        if self.need_ack or not self.is_printer_ready:
+            return
+        commands = self.input_commands
+        limit = min(len(commands), self.ack_ahead_limit)
+        while self.acked_ahead < limit:
+            line = commands[self.acked_ahead]
+            if (line.split(';', 1)[0].strip()
+                or line in gcodefile.MARKER_LINES):
+                if gcodefile.parse_move_line(line) is None:
+                    break
+                self.write_output("ok\n")
+                self.output_acks += 1
+            self.acked_ahead += 1
+    def process_line(self, line, need_ack=True):
+        self.lines_processed += 1
+        # Ignore comments and leading/trailing spaces
+        line = origline = line.strip()
+        cpos = line.find(';')
+        if cpos >= 0:
+            line = line[:cpos]
+        # Fast path for simple G0/G1 moves
+        if line[:2] in gcodefile.MOVE_CMDS and self.is_printer_ready:
+            move = gcodefile.parse_move(line)
+            if move is not None:
+                self.need_ack = need_ack
+                self.invoke_handler(self.move, move, 'G1')
+                self.ack()
+                return
+        # Break command into parts
+        parts = self.args_r.split(line)[1:]
+        params = dict((parts[i].upper(), parts[i+1].strip())
+                      for i in range(0, len(parts), 2))
+        params['#original'] = origline
+        if parts and parts[0].upper() == 'N':
+            # Skip line number at start of command
+            del parts[:2]
+        if not parts:
+            if origline == gcodefile.M112_DONE_LINE:
+                if self.toolhead is None:
+                    # The emergency stop could not be issued when the
+                    # line was read - run the M112 command now
+                    self.process_line('M112', need_ack)
+                    return
+                self.need_ack = need_ack
+                self.ack()
+                return
+            if origline == gcodefile.LONG_LINE:
+                self.need_ack = need_ack
+                self.respond_error("G-Code line too long")
+                self.ack()
+                return
+            self.cmd_default(params)
+            return
+        params['#command'] = cmd = parts[0].upper() + parts[1].strip()
+        # Invoke handler for command
+        self.need_ack = need_ack
+        handler = self.gcode_handlers.get(cmd, self.cmd_default)
+        self.invoke_handler(handler, params, cmd)
+        self.ack()
+    def invoke_handler(self, handler, params, cmd):
+        if (self.toolhead is not None and self.toolhead.is_held
+            and cmd != 'M112'
+            and not getattr(self, 'cmd_'+cmd+'_when_not_ready', False)):
+            # Only M112 and status commands run during a feed hold
+            self.toolhead.wait_feed_hold()
+        try:
+            handler(params)
+        except:
+            logging.exception("Exception in command handler")
+            self.toolhead.force_shutdown()
+            self.respond_error('Internal error on command:"%s"' % (cmd,))
     def process_data(self, eventtime):
-        data = os.read(self.fd, 4096)
+        data = os.read(self.fd, self.read_size)
         self.input_log.append((eventtime, data))
+        if self.recorder is not None:
+            self.recorder.record_input(eventtime, data)
+        is_eof = not data
+        # Use larger reads while the sender keeps the input full
+        if len(data) >= self.read_size:
+            self.read_size = min(2 * self.read_size, self.max_read_size)
+        else:
+            self.read_size = self.min_read_size
+        if self.input_decoder is not None:
+            data = self.input_decoder.decompress(data)
+        elif not self.bytes_read and data[:2] == gcodefile.GZIP_MAGIC:
+            # Input is a gzip compressed stream
+            self.input_decoder = gcodefile.GzipDecoder()
+            data = self.input_decoder.decompress(data)
+        if is_eof:
+            # Process any input left in the decoder and a final line
+            # that has no newline
+            if self.input_decoder is not None:
+                data = self.input_decoder.flush()
+            if self.partial_input or data:
+                data += '\n'
         self.bytes_read += len(data)
         lines = data.split('\n')
-        lines[0] = self.input_commands.pop() + lines[0]
+        lines[0] = self.partial_input + lines[0]
+        self.partial_input = lines.pop()
+        if not self.is_fileinput:
+            self.check_m112(data, lines, eventtime)
         self.input_commands.extend(lines)
+        if self.ack_ahead_limit:
+            self.ack_ahead()
         if self.is_processing_data:
-            if len(lines) <= 1:
+            if not lines:
+                return
+            if len(self.input_commands) < max(self.ack_ahead_limit,
+                                              self.HOLD_INPUT_LINES):
+                # Keep reading (and checking for M112) while the
+                # command buffer has room
                 return
-            if not self.is_fileinput and lines[0].strip().upper() == 'M112':
-                self.cmd_M112({})
             self.reactor.unregister_fd(self.fd_handle)
             self.fd_handle = None
+            self.input_held = True
             return
         self.is_processing_data = True
         self.process_commands(eventtime)
         self.is_processing_data = False
+        self.flush_output(eventtime)
+        self.check_scripts()
+        self.input_held = False
         if self.fd_handle is None:
             self.fd_handle = self.reactor.register_fd(self.fd, self.process_data)
-        if not data and self.is_fileinput:
+        if is_eof and self.is_fileinput:
             self.motor_heater_off()
             self.printer.request_exit_eof()
+    def check_m112(self, data, lines, eventtime):
+        # Act on an emergency stop as soon as it is read - ahead of any
+        # queued commands.  The line is replaced with a marker so that
+        # it is still acknowledged in order.
+        if self.toolhead is None:
+            return
+        if '112' not in data and not (lines and '112' in lines[0]):
+            return
+        for i in range(len(lines)):
+            if lines[i].strip().upper() == 'M112':
+                lines[i] = gcodefile.M112_DONE_LINE
+                self.emergency_stop(eventtime)
+    def emergency_stop(self, eventtime):
+        if self.toolhead is None:
+            return
+        self.estop_time = eventtime
+        self.toolhead.force_shutdown()
+        self.reactor.update_timer(self.estop_timer, self.reactor.NOW)
+    def report_estop(self, eventtime):
+        # Report the time from reading the emergency stop request to
+        # the emergency_stop command being written to the serial port
+        # (and the estimated time its transmission completed)
+        sent_time, done_time = self.printer.mcu.get_emergency_stop_times()
+        if not sent_time:
+            if eventtime > self.estop_time + 1.:
+                logging.warn("Emergency stop not sent after 1 second")
+                return self.reactor.NEVER
+            return eventtime + 0.001
+        msg = ("Emergency stop latency: %.3fms to write, %.3fms to transmit"
+               % ((sent_time - self.estop_time) * 1000.,
+                  (max(done_time, sent_time) - self.estop_time) * 1000.))
+        logging.info(msg)
+        self.respond_info(msg)
+        return self.reactor.NEVER
+    def finish_file(self):
+        logging.info("Finished reading G-Code file (%d lines)" % (
+            self.lines_processed,))
+        self.motor_heater_off()
+        self.printer.request_exit_eof()
+        return self.reactor.NEVER
+    def note_file_progress(self, progress):
+        if progress >= self.next_progress_report:
+            logging.info("G-Code file progress: %.0f%% (%d lines)" % (
+                progress * 100., self.lines_processed))
+            self.next_progress_report = int(progress * 10. + 1.) / 10.
+    def process_file(self, eventtime):
+        # Batch input from a memory mapped file (no fd polling needed)
+        if self.is_processing_data:
+            return eventtime + 0.100
+        data = self.input_file.read(self.max_read_size)
+        self.bytes_read += len(data)
+        if not data:
+            if not self.partial_input:
+                return self.finish_file()
+            # Process a final line that has no newline
+            data = '\n'
+        lines = data.split('\n')
+        lines[0] = self.partial_input + lines[0]
+        self.partial_input = lines.pop()
+        self.input_commands.extend(lines)
+        self.is_processing_data = True
+        self.process_commands(eventtime)
+        self.is_processing_data = False
+        self.check_scripts()
+        self.note_file_progress(self.input_file.get_progress())
+        return self.reactor.NOW
+    def process_cache(self, eventtime):
+        # Batch input replayed from a pre-parsed cache file
+        if self.is_processing_data:
+            return eventtime + 0.100
+        records = self.input_cache.read(1024)
+        if not records:
+            return self.finish_file()
+        self.is_processing_data = True
+        starttime = time.time()
+        self.process_records(records)
+        self.process_time += time.time() - starttime
+        self.is_processing_data = False
+        self.check_scripts()
+        self.note_file_progress(self.input_cache.get_progress())
+        return self.reactor.NOW
+    def process_records(self, records):
+        # Process pre-parsed moves and lines of G-Code
+        for rec in records:
+            if rec.__class__ is str:
+                self.process_line(rec)
+            elif self.is_printer_ready:
+                self.lines_processed += 1
+                self.need_ack = True
+                self.invoke_handler(self.move, rec, 'G1')
+                self.ack()
+            else:
+                self.lines_processed += 1
+                self.cmd_default({'#command': 'G1'})
+    def process_worker(self, eventtime):
+        # Input tokenized by the worker process
+        nbytes, is_m112 = self.worker.read_notes()
+        self.bytes_read += nbytes
+        if is_m112:
+            self.emergency_stop(eventtime)
+        if self.is_processing_data:
+            # The active pass processes the new records when it is done
+            return
+        self.is_processing_data = True
+        starttime = time.time()
+        self.process_worker_records()
+        self.process_time += time.time() - starttime
+        self.is_processing_data = False
+        self.flush_output(eventtime)
+        self.check_scripts()
+        self.input_held = False
+        if self.input_file is not None:
+            self.input_file.seek(self.worker.file_pos)
+            self.note_file_progress(self.input_file.get_progress())
+        if self.worker.is_eof and not self.worker.available:
+            if self.worker_handle is not None:
+                self.reactor.unregister_fd(self.worker_handle)
+                self.worker_handle = None
+            self.finish_file()
+            return
+        if self.worker_handle is None:
+            self.worker_handle = self.reactor.register_fd(
+                self.worker.note_fd, self.process_worker)
+    def process_worker_records(self):
+        while 1:
+            records = self.worker.read(1024)
+            if not records:
+                break
+            self.process_records(records)
+    # Scripts from other interfaces
+    def queue_script(self, lines, output_callback, done_callback):
+        # Run a block of G-Code lines with their responses sent to
+        # output_callback.  The block is acknowledged as a whole by
+        # calling done_callback with the number of lines processed.
+        if self.recorder is not None:
+            self.recorder.record_script(time.time(), lines)
+        self.scripts.append((lines, output_callback, done_callback))
+        self.check_scripts()
+    def check_scripts(self):
+        if self.scripts and not self.is_processing_data:
+            self.reactor.update_timer(self.script_timer, self.reactor.NOW)
+    def process_scripts(self, eventtime):
+        if self.is_processing_data:
+            # The active input pass will run the scripts when done
+            return self.reactor.NEVER
+        self.is_processing_data = True
+        starttime = time.time()
+        while self.scripts:
+            lines, output_callback, done_callback = self.scripts.popleft()
+            start_lines = self.lines_processed
+            self.output_callback = output_callback
+            for line in lines:
+                self.process_line(line)
+            self.output_callback = None
+            done_callback(self.lines_processed - start_lines)
+        # Process any input that arrived while the scripts were running
+        self.process_input_commands()
+        if self.worker is not None:
+            self.process_worker_records()
+        self.process_time += time.time() - starttime
+        self.is_processing_data = False
+        self.flush_output(eventtime)
+        self.release_input()
+        return self.reactor.NEVER
+    def process_batch(self, records, output_callback):
+        # Process a block of pre-parsed records (eg, from the job
+        # queue) with responses sent to output_callback.  The caller
+        # must check that no other input pass is active.
+        self.is_processing_data = True
+        starttime = time.time()
+        self.output_callback = output_callback
+        self.process_records(records)
+        self.output_callback = None
+        self.process_input_commands()
+        if self.worker is not None:
+            self.process_worker_records()
+        self.process_time += time.time() - starttime
+        self.is_processing_data = False
+        self.flush_output(starttime)
+        self.check_scripts()
+        self.release_input()
+    def release_input(self):
+        # Resume reading input that was held during another pass
+        if not self.input_held:
+            return
+        self.input_held = False
+        if self.worker is not None:
+            self.worker_handle = self.reactor.register_fd(
+                self.worker.note_fd, self.process_worker)
+        else:
+            self.fd_handle = self.reactor.register_fd(
+                self.fd, self.process_data)
     # Response handling
+    def write_output(self, msg):
+        # Responses are gathered and sent with a single write at the
+        # end of an input pass.  The flush timer also sends them if a
+        # command blocks (eg, waiting on a heater, homing, or a full
+        # move buffer) as the reactor runs timers during any pause.
+        if not self.output_buffer:
+            self.reactor.update_timer(self.output_timer, self.reactor.NOW)
+        self.output_buffer.append(msg)
+    def flush_output(self, eventtime):
+        if self.output_buffer:
+            os.write(self.fd, "".join(self.output_buffer))
+            self.output_buffer = []
+            self.output_writes += 1
+        self.reactor.update_timer(self.output_timer, self.reactor.NEVER)
+        return self.reactor.NEVER
     def ack(self, msg=None):
         if not self.need_ack or self.is_fileinput:
             return
+        self.need_ack = False
+        if self.output_callback is not None:
+            # Scripts are acknowledged as a block
+            if msg:
+                self.output_callback(msg)
+            return
         if msg:
-            os.write(self.fd, "ok %s\n" % (msg,))
+            self.write_output("ok %s\n" % (msg,))
         else:
-            os.write(self.fd, "ok\n")
-        self.need_ack = False
+            self.write_output("ok\n")
+        self.output_acks += 1
     def respond(self, msg):
         logging.debug(msg)
+        if self.output_callback is not None:
+            self.output_callback(msg)
+            return
         if self.is_fileinput:
             return
-        os.write(self.fd, msg+"\n")
+        self.write_output(msg+"\n")
     def respond_info(self, msg):
         lines = [l.strip() for l in msg.strip().split('\n')]
         self.respond("// " + "\n// ".join(lines))
@@ -182,11 +689,33 @@ class GCodeParser:
             self.respond(self.get_temp())
             eventtime = self.reactor.pause(eventtime + 1.)
     def set_temp(self, heater, params, wait=False):
-        print_time = self.toolhead.get_last_move_time()
         temp = float(params.get('S', '0'))
+        if not wait:
+            # Apply the new target when the preceding move is processed
+            self.toolhead.register_lookahead_callback(
+                lambda print_time: heater.set_temp(print_time, temp))
+            return
+        print_time = self.toolhead.get_last_move_time()
         heater.set_temp(print_time, temp)
-        if wait:
+        if self.defer_heater_wait:
+            # Wait at the next extruding move so that homing and other
+            # moves can run while the heater warms up
+            if heater not in self.pending_heaters:
+                self.pending_heaters.append(heater)
+            return
+        self.bg_temp(heater)
+    def wait_pending_heaters(self):
+        heaters = self.pending_heaters
+        self.pending_heaters = []
+        for heater in heaters:
             self.bg_temp(heater)
+    def set_fan_speed(self, value):
+        if value == self.fan_speed:
+            # Don't queue a change that would have no effect
+            return
+        self.fan_speed = value
+        self.toolhead.register_lookahead_callback(
+            lambda print_time: self.fan.set_speed(print_time, value))
     # Individual command handlers
     def cmd_default(self, params):
         if not self.is_printer_ready:
@@ -197,25 +726,117 @@ class GCodeParser:
             logging.debug(params['#original'])
             return
         self.respond('echo:Unknown command:"%s"' % (cmd,))
+    # Move handling
+    def move(self, move):
+        # Apply a parse_move() style [X, Y, Z, E, F] list to the position
+        for p in (0, 1, 2, 3):
+            v = move[p]
+            if v is None:
+                continue
+            if not self.absolutecoord or (p>2 and not self.absoluteextrude):
+                # value relative to position of last move
+                self.last_position[p] += v
+            else:
+                # value relative to base coordinate position
+                self.last_position[p] = v + self.base_position[p]
+        if move[4] is not None:
+            self.speed = move[4] / 60.
+        if self.pending_heaters and move[3] is not None:
+            self.wait_pending_heaters()
+        try:
+            self.toolhead.move(self.last_position, self.speed)
+        except homing.EndstopError, e:
+            self.respond_error(str(e))
+            self.last_position = self.toolhead.get_position()
     cmd_G1_aliases = ['G0']
     def cmd_G1(self, params):
         # Move
+        move = [None, None, None, None, None]
         for a, p in self.axis2pos.items():
             if a in params:
-                v = float(params[a])
-                if not self.absolutecoord or (p>2 and not self.absoluteextrude):
-                    # value relative to position of last move
-                    self.last_position[p] += v
-                else:
-                    # value relative to base coordinate position
-                    self.last_position[p] = v + self.base_position[p]
+                move[p] = float(params[a])
+        if 'F' in params:
+            move[4] = float(params['F'])
+        self.move(move)
+    def arc(self, params, clockwise):
+        # Determine end position (same coordinate rules as G1)
+        start = list(self.last_position)
+        end = list(start)
+        for a, p in self.axis2pos.items():
+            if a not in params:
+                continue
+            v = float(params[a])
+            if not self.absolutecoord or (p>2 and not self.absoluteextrude):
+                end[p] += v
+            else:
+                end[p] = v + self.base_position[p]
         if 'F' in params:
             self.speed = float(params['F']) / 60.
+        # Determine arc center (I and J are relative to the start)
+        dx, dy = end[0] - start[0], end[1] - start[1]
+        if 'R' in params:
+            radius = float(params['R'])
+            chord = math.sqrt(dx*dx + dy*dy)
+            h2 = 4. * radius * radius - chord * chord
+            if not chord or h2 < 0.:
+                self.respond_error("Invalid arc radius: %s" % (
+                    params['#original'],))
+                return
+            h = -math.sqrt(h2) / chord
+            if not clockwise:
+                h = -h
+            if radius < 0.:
+                h = -h
+            offset_i = 0.5 * (dx - dy * h)
+            offset_j = 0.5 * (dy + dx * h)
+        else:
+            offset_i = float(params.get('I', '0'))
+            offset_j = float(params.get('J', '0'))
+        center_x, center_y = start[0] + offset_i, start[1] + offset_j
+        radius = math.sqrt(offset_i*offset_i + offset_j*offset_j)
+        if not radius:
+            self.respond_error("Invalid arc center: %s" % (
+                params['#original'],))
+            return
+        # Determine the angle swept by the arc (same start/end is a circle)
+        start_angle = math.atan2(-offset_j, -offset_i)
+        end_x, end_y = end[0] - center_x, end[1] - center_y
+        sweep = math.atan2(-offset_i * end_y + offset_j * end_x,
+                           -offset_i * end_x - offset_j * end_y)
+        if clockwise and sweep >= -ARC_EPSILON:
+            sweep -= 2. * math.pi
+        elif not clockwise and sweep <= ARC_EPSILON:
+            sweep += 2. * math.pi
+        # Split the arc into segments that stay within arc_tolerance
+        # of the true arc
+        max_angle = math.pi * .5
+        if self.arc_tolerance < radius:
+            max_angle = min(max_angle, 2. * math.acos(
+                1. - self.arc_tolerance / radius))
+        count = max(1, int(math.ceil(abs(sweep) / max_angle)))
+        dz, de = end[2] - start[2], end[3] - start[3]
+        if self.pending_heaters and de:
+            self.wait_pending_heaters()
         try:
-            self.toolhead.move(self.last_position, self.speed)
+            for i in range(1, count):
+                r = float(i) / count
+                angle = start_angle + sweep * r
+                self.last_position = [
+                    center_x + radius * math.cos(angle),
+                    center_y + radius * math.sin(angle),
+                    start[2] + dz * r, start[3] + de * r]
+                self.toolhead.move(self.last_position, self.speed)
+            self.last_position = end
+            self.toolhead.move(end, self.speed)
         except homing.EndstopError, e:
             self.respond_error(str(e))
             self.last_position = self.toolhead.get_position()
+    def cmd_G2(self, params):
+        # Clockwise arc
+        self.arc(params, True)
+    def cmd_G3(self, params):
+        # Counter-clockwise arc
+        self.arc(params, False)
     def cmd_G4(self, params):
         # Dwell
         if 'S' in params:
@@ -237,6 +858,10 @@ class GCodeParser:
                 axes.append(self.axis2pos[axis])
         if not axes:
             axes = [0, 1, 2]
+        self.home_axes(axes)
+    def home_axes(self, axes):
+        # Home the given axes and return the list of axes that were
+        # homed (or an empty list on failure)
         homing_state = homing.Homing(self.toolhead, axes)
         if self.is_fileinput:
             homing_state.set_no_verify_retract()
@@ -245,11 +870,12 @@ class GCodeParser:
         except homing.EndstopError, e:
             self.toolhead.motor_off()
             self.respond_error(str(e))
-            return
+            return []
         newpos = self.toolhead.get_position()
         for axis in homing_state.get_axes():
             self.last_position[axis] = newpos[axis]
             self.base_position[axis] = -self.homing_add[axis]
+        return homing_state.get_axes()
     def cmd_G90(self, params):
         # Use absolute coordinates
         self.absolutecoord = True
@@ -317,12 +943,10 @@ class GCodeParser:
         self.set_temp(self.heater_bed, params, wait=True)
     def cmd_M106(self, params):
         # Set fan speed
-        print_time = self.toolhead.get_last_move_time()
-        self.fan.set_speed(print_time, float(params.get('S', '255')) / 255.)
+        self.set_fan_speed(float(params.get('S', '255')) / 255.)
     def cmd_M107(self, params):
         # Turn fan off
-        print_time = self.toolhead.get_last_move_time()
-        self.fan.set_speed(print_time, 0)
+        self.set_fan_speed(0.)
     def cmd_M206(self, params):
         # Set home offset
         for a, p in self.axis2pos.items():
@@ -0,0 +1,188 @@
+# On-disk cache of pre-parsed G-Code files
+#
+# Copyright (C) 2016  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os, mmap, struct, hashlib, logging, time
+import gcodefile
+
+# Bump CACHE_VERSION whenever the record format or the meaning of the
+# stored values (ie, the G-Code position state machine) changes.
+CACHE_VERSION = 1
+CACHE_MAGIC = 'KGCC'
+HEADER = struct.Struct('<4sI20s')
+
+# Each record starts with a type byte.  Types below 0x20 are G0/G1
+# moves where the type is a bitmask of the parameters present
+# (X=1, Y=2, Z=4, E=8, F=16) followed by one double per parameter.
+# REC_LINE records hold any other command as an opaque line of text.
+REC_LINE = 0x80
+LINE_HEADER = struct.Struct('<BI')
+MOVE_PARAMS = [tuple(p for p in range(5) if mask & (1 << p))
+               for mask in range(32)]
+MOVE_RECORDS = [struct.Struct('<B' + 'd' * len(params))
+                for params in MOVE_PARAMS]
+
+def encode_move(move):
+    mask = 0
+    values = []
+    for p in range(5):
+        if move[p] is not None:
+            mask |= 1 << p
+            values.append(move[p])
+    return MOVE_RECORDS[mask].pack(mask, *values)
+
+def encode_line(line):
+    return LINE_HEADER.pack(REC_LINE, len(line)) + line
+
+def encode_lines(lines):
+    out = []
+    for line in lines:
+        line = line.strip()
+        if not line.split(';', 1)[0].strip():
+            # Blank lines and comments don't need to be replayed
+            continue
+        move = gcodefile.parse_move_line(line)
+        if move is not None:
+            out.append(encode_move(move))
+        else:
+            out.append(encode_line(line))
+    return ''.join(out)
+
+# Convert the contents of a GCodeFile into a cache file.  If
+# 'check_lines' is set it is called with each block of lines before
+# the block is stored.
+def build_cache(gfile, filename, digest, check_lines=None):
+    tmpname = "%s.tmp%d" % (filename, os.getpid())
+    f = open(tmpname, 'wb')
+    f.write(HEADER.pack(CACHE_MAGIC, CACHE_VERSION, digest))
+    gfile.seek(0)
+    partial = ""
+    while 1:
+        data = gfile.read(1024 * 1024)
+        if not data:
+            break
+        lines = data.split('\n')
+        lines[0] = partial + lines[0]
+        partial = lines.pop()
+        if check_lines is not None:
+            check_lines(lines)
+        f.write(encode_lines(lines))
+    if check_lines is not None and partial:
+        check_lines([partial])
+    f.write(encode_lines([partial]))
+    gfile.seek(0)
+    f.close()
+    os.rename(tmpname, filename)
+
+# Sequential reader of records from a cache file
+class GCodeCache:
+    def __init__(self, filename, digest):
+        f = open(filename, 'rb')
+        try:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        self.size = len(self.data)
+        if self.size < HEADER.size:
+            raise ValueError("Truncated cache file")
+        magic, version, file_digest = HEADER.unpack_from(self.data, 0)
+        if (magic != CACHE_MAGIC or version != CACHE_VERSION
+            or file_digest != digest):
+            raise ValueError("Stale cache file")
+        self.pos = HEADER.size
+    def read(self, count):
+        # Return up to 'count' records.  Each record is either a
+        # parse_move() style list or a string containing a G-Code line.
+        data = self.data
+        pos = self.pos
+        out = []
+        while count and pos < self.size:
+            rtype = ord(data[pos])
+            if rtype == REC_LINE:
+                rtype, length = LINE_HEADER.unpack_from(data, pos)
+                pos += LINE_HEADER.size
+                out.append(data[pos:pos+length])
+                pos += length
+            else:
+                rec = MOVE_RECORDS[rtype]
+                values = rec.unpack_from(data, pos)
+                pos += rec.size
+                move = [None, None, None, None, None]
+                for p, v in zip(MOVE_PARAMS[rtype], values[1:]):
+                    move[p] = v
+                out.append(move)
+            count -= 1
+        self.pos = pos
+        return out
+    def get_progress(self):
+        return float(self.pos) / self.size
+    def close(self):
+        self.data.close()
+
+# Remove old files from a cache directory.  Cache files from another
+# CACHE_VERSION (and temporary files left by an interrupted build) are
+# removed, and then the least recently used files are removed until
+# the directory holds at most CACHE_MAX_SIZE bytes.
+CACHE_MAX_SIZE = 256 * 1024 * 1024
+CACHE_TMP_AGE = 3600.
+
+def prune_cache(cachedir, keep):
+    files = []
+    now = time.time()
+    for name in os.listdir(cachedir):
+        filename = os.path.join(cachedir, name)
+        if filename == keep or '.kgc' not in name:
+            continue
+        try:
+            st = os.stat(filename)
+            if not name.endswith('.kgc'):
+                if st.st_mtime + CACHE_TMP_AGE < now:
+                    os.unlink(filename)
+                continue
+            f = open(filename, 'rb')
+            try:
+                header = f.read(HEADER.size)
+            finally:
+                f.close()
+            if (len(header) < HEADER.size
+                or HEADER.unpack(header)[:2] != (CACHE_MAGIC, CACHE_VERSION)):
+                logging.info("Removing stale G-Code cache %s" % (filename,))
+                os.unlink(filename)
+                continue
+            files.append((st.st_mtime, st.st_size, filename))
+        except EnvironmentError:
+            continue
+    total = os.path.getsize(keep) + sum([
+        size for mtime, size, filename in files])
+    for mtime, size, filename in sorted(files):
+        if total <= CACHE_MAX_SIZE:
+            break
+        logging.info("Removing old G-Code cache %s" % (filename,))
+        try:
+            os.unlink(filename)
+        except EnvironmentError:
+            continue
+        total -= size
+
+# Return a GCodeCache for a GCodeFile - building the cache if needed
+def open_cache(gfile, cachedir):
+    digest = hashlib.sha1(gfile.data).digest()
+    filename = os.path.join(cachedir, "%s.kgc" % (digest.encode('hex'),))
+    try:
+        cache = GCodeCache(filename, digest)
+    except (EnvironmentError, ValueError), e:
+        logging.info("Building G-Code cache %s (%s)" % (filename, e))
+    else:
+        try:
+            # Note the use of the file (see prune_cache())
+            os.utime(filename, None)
+        except EnvironmentError:
+            pass
+        return cache
+    build_cache(gfile, filename, digest)
+    try:
+        prune_cache(cachedir, filename)
+    except EnvironmentError, e:
+        logging.warn("Unable to remove old G-Code cache files: %s" % (e,))
+    return GCodeCache(filename, digest)
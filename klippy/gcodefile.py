@@ -0,0 +1,182 @@
+# Support for reading G-Code input files
+#
+# Copyright (C) 2016  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os, mmap, zlib, time
+
+# An M112 line is replaced with this line once the emergency stop has
+# been issued (when the line is read).  It is only acknowledged when it
+# is processed.
+M112_DONE_LINE = '; M112 (emergency stop issued)'
+# A line that could not be passed on (it is reported as an error)
+LONG_LINE = '; G-Code line too long'
+MARKER_LINES = (M112_DONE_LINE, LONG_LINE)
+
+# Fast tokenizer for simple "G1 X10 Y10 E1 F3000" style move commands.
+# Returns a list of [X, Y, Z, E, F] values (with None for any missing
+# parameter) or None if the line must go through the generic parser.
+MOVE_WORDS = {'X': 0, 'Y': 1, 'Z': 2, 'E': 3, 'F': 4,
+              'x': 0, 'y': 1, 'z': 2, 'e': 3, 'f': 4}
+MOVE_CMDS = {'G1': 1, 'G0': 1, 'g1': 1, 'g0': 1}
+def parse_move(line):
+    parts = line.split()
+    if not parts or parts[0] not in MOVE_CMDS:
+        return None
+    values = [None, None, None, None, None]
+    for word in parts[1:]:
+        pos = MOVE_WORDS.get(word[0])
+        if pos is None:
+            return None
+        value = word[1:]
+        try:
+            values[pos] = float(value)
+        except ValueError:
+            return None
+        if 'e' in value or 'E' in value or 'n' in value or 'N' in value:
+            # Exponents, "inf", and "nan" are split differently by args_r
+            return None
+    return values
+
+# Run parse_move() on a raw line of input (that may contain a comment)
+def parse_move_line(line):
+    cpos = line.find(';')
+    if cpos >= 0:
+        line = line[:cpos]
+    if line.lstrip()[:2] not in MOVE_CMDS:
+        return None
+    return parse_move(line)
+
+# Memory mapped access to a G-Code file that is walked in place
+class GCodeFile:
+    def __init__(self, fd):
+        self.size = os.fstat(fd).st_size
+        self.data = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        self.pos = 0
+        self.decoder = None
+    def read(self, size):
+        # Return up to 'size' bytes ending on a line boundary
+        pos = self.pos
+        end = pos + size
+        if end < self.size:
+            nl = self.data.rfind('\n', pos, end)
+            if nl >= 0:
+                end = nl + 1
+        else:
+            end = self.size
+        self.pos = end
+        return self.data[pos:end]
+    def seek(self, pos):
+        self.pos = pos
+    def tell(self):
+        return self.pos
+    def get_progress(self):
+        return float(self.pos) / self.size
+    def close(self):
+        self.data.close()
+
+######################################################################
+# Compressed input
+######################################################################
+
+GZIP_MAGIC = '\x1f\x8b'
+
+# Incremental gzip decompression (concatenated gzip members, as
+# produced by parallel compressors, are also supported)
+class GzipDecoder:
+    def __init__(self):
+        self.zobj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.tail = ""
+        self.bytes_in = self.bytes_out = 0
+        self.inflate_time = 0.
+    def decompress(self, data, max_size=0):
+        # Return the inflated contents of 'data' along with any input
+        # left over from the previous call.  If 'max_size' is set then
+        # at most that many bytes are returned and the remaining input
+        # is kept for the next call.
+        starttime = time.time()
+        self.bytes_in += len(data)
+        if self.tail:
+            data = self.tail + data
+        out = []
+        out_size = 0
+        while data:
+            limit = 0
+            if max_size:
+                limit = max_size - out_size
+                if limit <= 0:
+                    break
+            res = self.zobj.decompress(data, limit)
+            out.append(res)
+            out_size += len(res)
+            data = self.zobj.unconsumed_tail
+            unused = self.zobj.unused_data
+            if unused:
+                # End of a gzip member - check for another one
+                self.zobj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                data = unused
+                if data[:2] != GZIP_MAGIC:
+                    # Ignore trailing garbage (eg, zero padding)
+                    data = ""
+        self.tail = data
+        self.bytes_out += out_size
+        self.inflate_time += time.time() - starttime
+        return ''.join(out)
+    def flush(self):
+        res = self.zobj.flush()
+        self.bytes_out += len(res)
+        return res
+    def get_stats(self):
+        rate = 0.
+        if self.inflate_time > 0.:
+            rate = self.bytes_out / self.inflate_time
+        return "gzipin=%d gzip_inflate_time=%.3f gzip_bytes_per_sec=%.0f" % (
+            self.bytes_in, self.inflate_time, rate)
+
+# Memory mapped gzip compressed G-Code file that is inflated on demand
+class GzipGCodeFile:
+    def __init__(self, fd):
+        self.size = os.fstat(fd).st_size
+        self.data = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        self.pos = 0
+        self.decoder = GzipDecoder()
+    def read(self, size):
+        # Return up to 'size' bytes of inflated data (the data does not
+        # necessarily end on a line boundary).  The input is consumed
+        # in chunks no larger than 'size' so that the time spent in
+        # each call is bounded.
+        decoder = self.decoder
+        while 1:
+            chunk = ""
+            if not decoder.tail and self.pos < self.size:
+                chunk = self.data[self.pos:self.pos+size]
+                self.pos += len(chunk)
+            data = decoder.decompress(chunk, size)
+            if data:
+                return data
+            if not decoder.tail and self.pos >= self.size:
+                return decoder.flush()
+    def seek(self, pos):
+        # Only a seek to the start of the file restarts decompression
+        # (other positions are only used for progress reporting)
+        self.pos = pos
+        if not pos:
+            self.decoder = GzipDecoder()
+    def tell(self):
+        return self.pos - len(self.decoder.tail)
+    def get_progress(self):
+        return float(self.tell()) / self.size
+    def close(self):
+        self.data.close()
+
+# Return a GCodeFile for the given fd (or None if it can't be mapped)
+def open_gcode_file(fd):
+    try:
+        gfile = GCodeFile(fd)
+    except (EnvironmentError, ValueError):
+        # Not a regular file (eg, a pipe) or an empty file
+        return None
+    if gfile.data[:2] == GZIP_MAGIC:
+        gfile.close()
+        return GzipGCodeFile(fd)
+    return gfile
@@ -0,0 +1,264 @@
+# Index of G-Code file positions for resuming a print part way through
+#
+# Copyright (C) 2016  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os, re, json, bisect, logging
+import gcodefile
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = '.kgi'
+# Maximum amount of input between checkpoints (this bounds the amount
+# of the file that needs to be scanned when resuming)
+CHECKPOINT_BYTES = 65536
+
+class error(Exception):
+    pass
+
+
+######################################################################
+# Modal state tracking
+######################################################################
+
+# Track the G-Code state that must be restored to resume at a given
+# point in a file.  This follows the same coordinate rules as
+# GCodeParser - last_position is in toolhead coordinates and
+# base_position is the offset of the G-Code coordinate system.  The
+# toolhead position after a G28 depends on the printer config, so the
+# position of a homed axis is unknown (None) until its next absolute
+# move.
+class GCodeState:
+    args_r = re.compile('([a-zA-Z_]+|[a-zA-Z*])')
+    def __init__(self, values=None):
+        self.absolutecoord = self.absoluteextrude = True
+        self.base_position = [0.0, 0.0, 0.0, 0.0]
+        self.last_position = [0.0, 0.0, 0.0, 0.0]
+        self.homing_add = [0.0, 0.0, 0.0, 0.0]
+        self.speed = 25.0
+        self.extruder_temp = self.bed_temp = self.fan_speed = 0.
+        self.max_extrude_z = None
+        self.layer = 0
+        if values is not None:
+            (self.absolutecoord, self.absoluteextrude, base_position,
+             last_position, homing_add, self.speed,
+             self.extruder_temp, self.bed_temp, self.fan_speed,
+             self.max_extrude_z, self.layer) = values
+            self.base_position = list(base_position)
+            self.last_position = list(last_position)
+            self.homing_add = list(homing_add)
+    def get_values(self):
+        return [self.absolutecoord, self.absoluteextrude,
+                list(self.base_position), list(self.last_position),
+                list(self.homing_add), self.speed, self.extruder_temp,
+                self.bed_temp, self.fan_speed, self.max_extrude_z,
+                self.layer]
+    def move(self, move):
+        last_position = self.last_position
+        start_z = last_position[2]
+        for p in (0, 1, 2, 3):
+            v = move[p]
+            if v is None:
+                continue
+            if not self.absolutecoord or (p>2 and not self.absoluteextrude):
+                if last_position[p] is not None:
+                    last_position[p] += v
+            elif self.base_position[p] is not None:
+                last_position[p] = v + self.base_position[p]
+            else:
+                last_position[p] = None
+        if move[4] is not None:
+            self.speed = move[4] / 60.
+        # A new layer starts with the first extruding XY move above
+        # all previously extruded moves
+        z = last_position[2]
+        if (move[3] is not None and z is not None and z == start_z
+            and (move[0] is not None or move[1] is not None)
+            and (self.max_extrude_z is None or z > self.max_extrude_z)):
+            self.max_extrude_z = z
+            self.layer += 1
+            return True
+        return False
+    def process_line(self, line):
+        # Update the state from a line of G-Code.  Returns True if the
+        # line is the first extruding move of a new layer.
+        cpos = line.find(';')
+        if cpos >= 0:
+            line = line[:cpos]
+        move = gcodefile.parse_move_line(line)
+        if move is not None:
+            return self.move(move)
+        parts = self.args_r.split(line)[1:]
+        if parts and parts[0].upper() == 'N':
+            del parts[:2]
+        if not parts:
+            return False
+        cmd = parts[0].upper() + parts[1].strip()
+        params = {}
+        for i in range(2, len(parts) - 1, 2):
+            try:
+                params[parts[i].upper()] = float(parts[i+1].strip())
+            except ValueError:
+                pass
+        handler = getattr(self, 'cmd_' + cmd, None)
+        if handler is None:
+            return False
+        return handler(params)
+    def _get_axes(self, params):
+        return [p for a, p in (('X', 0), ('Y', 1), ('Z', 2), ('E', 3))
+                if a in params]
+    def cmd_G1(self, params):
+        return self.move([params.get(a) for a in 'XYZEF'])
+    cmd_G0 = cmd_G2 = cmd_G3 = cmd_G1
+    def cmd_G28(self, params):
+        axes = self._get_axes(params)
+        if not axes or axes == [3]:
+            axes = [0, 1, 2]
+        for p in axes:
+            if p < 3:
+                self.last_position[p] = None
+                self.base_position[p] = -self.homing_add[p]
+    def cmd_G90(self, params):
+        self.absolutecoord = True
+    def cmd_G91(self, params):
+        self.absolutecoord = False
+    def cmd_G92(self, params):
+        axes = self._get_axes(params)
+        if not axes:
+            self.base_position = list(self.last_position)
+        for p in axes:
+            if self.last_position[p] is None:
+                self.base_position[p] = None
+            else:
+                self.base_position[p] = self.last_position[p] - params[
+                    'XYZE'[p]]
+    def cmd_M82(self, params):
+        self.absoluteextrude = True
+    def cmd_M83(self, params):
+        self.absoluteextrude = False
+    def cmd_M104(self, params):
+        self.extruder_temp = params.get('S', 0.)
+    cmd_M109 = cmd_M104
+    def cmd_M140(self, params):
+        self.bed_temp = params.get('S', 0.)
+    cmd_M190 = cmd_M140
+    def cmd_M106(self, params):
+        self.fan_speed = params.get('S', 255.) / 255.
+    def cmd_M107(self, params):
+        self.fan_speed = 0.
+    def cmd_M206(self, params):
+        for p in self._get_axes(params):
+            v = params['XYZE'[p]]
+            if self.base_position[p] is not None:
+                self.base_position[p] += self.homing_add[p] - v
+            self.homing_add[p] = v
+
+
+######################################################################
+# File index
+######################################################################
+
+# Each checkpoint is [file offset, line number, layer, state values]
+# where the state is the G-Code state before that line is run.  The
+# layer is only set on checkpoints at the start of a layer.  Line
+# numbers start at 1.
+class GCodeIndex:
+    def __init__(self, checkpoints):
+        self.checkpoints = checkpoints
+        self.lines = [c[1] for c in checkpoints]
+        self.layers = dict((c[2], c) for c in checkpoints
+                           if c[2] is not None)
+    def get_layer_count(self):
+        return len(self.layers)
+    def find_line(self, line):
+        pos = bisect.bisect_right(self.lines, line) - 1
+        return self.checkpoints[max(pos, 0)]
+    def find_layer(self, layer):
+        if layer not in self.layers:
+            raise error("Layer %d not found in G-Code file" % (layer,))
+        return self.layers[layer]
+    def locate(self, gfile, line=None, layer=None):
+        # Return (offset, line, state) for the start of the given line
+        # (or layer) by scanning forward from the nearest checkpoint
+        if layer is not None:
+            offset, cur_line, cur_layer, values = self.find_layer(layer)
+            line = cur_line
+        else:
+            offset, cur_line, cur_layer, values = self.find_line(line)
+        state = GCodeState(values)
+        data = gfile.data
+        while cur_line < line:
+            nl = data.find('\n', offset)
+            if nl < 0:
+                raise error("Line %d is past the end of the G-Code file" % (
+                    line,))
+            state.process_line(data[offset:nl])
+            offset = nl + 1
+            cur_line += 1
+        for p in (0, 1, 2, 3):
+            if (state.last_position[p] is None
+                or state.base_position[p] is None):
+                raise error("Position of %s axis unknown at line %d" % (
+                    'XYZE'[p], line))
+        return offset, line, state
+    def save(self, filename, size, mtime):
+        tmpname = "%s.tmp%d" % (filename, os.getpid())
+        f = open(tmpname, 'wb')
+        json.dump({'version': INDEX_VERSION, 'size': size, 'mtime': mtime,
+                   'checkpoints': self.checkpoints}, f,
+                  separators=(',', ':'))
+        f.close()
+        os.rename(tmpname, filename)
+
+# Scan a GCodeFile once and record checkpoints at the start of each
+# layer and at least every CHECKPOINT_BYTES of input
+def build_index(gfile):
+    state = GCodeState()
+    checkpoints = []
+    data = gfile.data
+    size = gfile.size
+    offset = 0
+    line_num = 1
+    next_checkpoint = 0
+    # A layer starts at the last Z change before its first extruding move
+    z_change = [0, 1, state.get_values()]
+    while offset < size:
+        nl = data.find('\n', offset)
+        if nl < 0:
+            nl = size
+        if offset >= next_checkpoint:
+            checkpoints.append([offset, line_num, None, state.get_values()])
+            next_checkpoint = offset + CHECKPOINT_BYTES
+        line = data[offset:nl]
+        if 'Z' in line or 'z' in line:
+            z_change = [offset, line_num, state.get_values()]
+        if state.process_line(line):
+            bisect.insort(checkpoints, [z_change[0], z_change[1],
+                                        state.layer, z_change[2]])
+        offset = nl + 1
+        line_num += 1
+    return GCodeIndex(checkpoints)
+
+# Return the index for a G-Code file - loading it from the file stored
+# alongside the G-Code file or building (and storing) it as needed
+def open_index(gfile, filename):
+    st = os.stat(filename)
+    index_name = filename + INDEX_SUFFIX
+    try:
+        f = open(index_name, 'rb')
+        try:
+            info = json.load(f)
+        finally:
+            f.close()
+        if (info.get('version') == INDEX_VERSION
+            and info.get('size') == st.st_size
+            and info.get('mtime') == st.st_mtime):
+            return GCodeIndex(info['checkpoints'])
+    except (EnvironmentError, ValueError):
+        pass
+    logging.info("Building G-Code index %s" % (index_name,))
+    index = build_index(gfile)
+    try:
+        index.save(index_name, st.st_size, st.st_mtime)
+    except EnvironmentError, e:
+        logging.info("Unable to store G-Code index %s: %s" % (index_name, e))
+    return index
@@ -0,0 +1,249 @@
+# Out-of-process G-Code pre-parser
+#
+# Copyright (C) 2016  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os, mmap, struct, select, errno, signal, logging
+import gcodefile, util
+
+# The worker process reads and tokenizes the input and places the
+# results in a ring of fixed size slots in shared memory.  A slot with
+# a type below 0x20 is a G0/G1 move where the type is a bitmask of the
+# parameters present (X=1, Y=2, Z=4, E=8, F=16).  A REC_LINE slot
+# holds the length of a line of text that is stored in the slots that
+# follow it.  REC_PAD marks the remainder of the ring as unused.
+RING_SLOTS = 4096
+SLOT = struct.Struct('<BxxxI5d')
+REC_LINE = 0x80
+REC_PAD = 0x81
+MOVE_PARAMS = [tuple(p for p in range(5) if mask & (1 << p))
+               for mask in range(32)]
+
+# The ring contents are handed between processes using messages on
+# two pipes.  The worker reports filled slots (along with the input
+# bytes consumed and the input file position) and the reactor reports
+# slots that may be reused.
+NOTE = struct.Struct('<BIIQ')
+NOTE_DATA, NOTE_M112, NOTE_EOF = range(3)
+CREDIT = struct.Struct('<I')
+READ_SIZE = 65536
+
+
+######################################################################
+# Worker process
+######################################################################
+
+class RingWriter:
+    def __init__(self, ring, note_fd, credit_fd):
+        self.ring = ring
+        self.note_fd = note_fd
+        self.credit_fd = credit_fd
+        self.head = 0
+        self.free = RING_SLOTS
+        self.filled = 0
+        self.file_pos = 0
+    def notify(self, kind=NOTE_DATA, nbytes=0):
+        os.write(self.note_fd, NOTE.pack(kind, self.filled, nbytes,
+                                         self.file_pos))
+        self.filled = 0
+    def read_credit(self):
+        data = os.read(self.credit_fd, CREDIT.size * 256)
+        if not data:
+            # Reactor process has gone away
+            raise EOFError()
+        for i in range(0, len(data), CREDIT.size):
+            self.free += CREDIT.unpack_from(data, i)[0]
+    def wait_credit(self, count):
+        while self.free < count:
+            if self.filled:
+                self.notify()
+            self.read_credit()
+    def write_move(self, move):
+        self.wait_credit(1)
+        mask = 0
+        values = [0., 0., 0., 0., 0.]
+        for p in range(5):
+            if move[p] is not None:
+                mask |= 1 << p
+                values[p] = move[p]
+        pos = self.head * SLOT.size
+        self.ring[pos:pos+SLOT.size] = SLOT.pack(mask, 0, *values)
+        self.head = (self.head + 1) % RING_SLOTS
+        self.free -= 1
+        self.filled += 1
+    def write_line(self, line):
+        count = 1 + (len(line) + SLOT.size - 1) // SLOT.size
+        if count > RING_SLOTS // 2:
+            # Lines must fit in half the ring - report an error instead
+            logging.error("G-Code worker: line too long (%d bytes)"
+                          % (len(line),))
+            line = gcodefile.LONG_LINE
+            count = 1 + (len(line) + SLOT.size - 1) // SLOT.size
+        if self.head + count > RING_SLOTS:
+            # Line would wrap - pad out the end of the ring
+            pad = RING_SLOTS - self.head
+            self.wait_credit(pad)
+            pos = self.head * SLOT.size
+            self.ring[pos:pos+SLOT.size] = SLOT.pack(
+                REC_PAD, pad, 0., 0., 0., 0., 0.)
+            self.head = 0
+            self.free -= pad
+            self.filled += pad
+        self.wait_credit(count)
+        pos = self.head * SLOT.size
+        self.ring[pos:pos+SLOT.size] = SLOT.pack(
+            REC_LINE, len(line), 0., 0., 0., 0., 0.)
+        pos += SLOT.size
+        self.ring[pos:pos+len(line)] = line
+        self.head = (self.head + count) % RING_SLOTS
+        self.free -= count
+        self.filled += count
+
+def run_worker(in_fd, gfile, writer, is_fileinput, partial, decoder):
+    is_start = not partial and decoder is None
+    while 1:
+        if gfile is not None:
+            data = gfile.read(READ_SIZE)
+            writer.file_pos = gfile.tell()
+        else:
+            if not is_fileinput:
+                res = select.select([in_fd, writer.credit_fd], [], [])
+                if writer.credit_fd in res[0]:
+                    writer.read_credit()
+                if in_fd not in res[0]:
+                    continue
+            try:
+                data = os.read(in_fd, READ_SIZE)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    continue
+                raise
+            if is_start and data:
+                # Detect a gzip compressed input stream
+                is_start = False
+                if data[:2] == gcodefile.GZIP_MAGIC:
+                    decoder = gcodefile.GzipDecoder()
+            if decoder is not None and data:
+                data = decoder.decompress(data)
+                if not data:
+                    continue
+        nbytes = len(data)
+        if not data:
+            if not is_fileinput:
+                continue
+            if decoder is not None:
+                # Process any input left in the decoder
+                data = decoder.flush()
+                decoder = None
+            if partial or data:
+                data += '\n'
+            else:
+                writer.notify(NOTE_EOF)
+                while 1:
+                    writer.read_credit()
+        lines = data.split('\n')
+        lines[0] = partial + lines[0]
+        partial = lines.pop()
+        for line in lines:
+            move = gcodefile.parse_move_line(line)
+            if move is not None:
+                writer.write_move(move)
+                continue
+            if not is_fileinput and line.strip().upper() == 'M112':
+                # Report emergency stop ahead of any queued commands
+                # (the host handles it, so only an ack is left to send)
+                writer.notify(NOTE_M112)
+                line = gcodefile.M112_DONE_LINE
+            writer.write_line(line)
+        writer.notify(NOTE_DATA, nbytes)
+
+def worker_main(in_fd, gfile, ring, note_fd, credit_fd, is_fileinput,
+                partial, decoder):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    writer = RingWriter(ring, note_fd, credit_fd)
+    try:
+        run_worker(in_fd, gfile, writer, is_fileinput, partial, decoder)
+    except EOFError:
+        pass
+    except:
+        logging.exception("Unhandled exception in G-Code worker")
+    os._exit(0)
+
+
+######################################################################
+# Reactor side interface
+######################################################################
+
+class GCodeWorker:
+    def __init__(self, in_fd, gfile, is_fileinput, partial="", decoder=None):
+        self.ring = mmap.mmap(-1, RING_SLOTS * SLOT.size)
+        note_rfd, note_wfd = os.pipe()
+        credit_rfd, credit_wfd = os.pipe()
+        self.pid = os.fork()
+        if not self.pid:
+            util.setup_child_process([in_fd, note_wfd, credit_rfd])
+            worker_main(in_fd, gfile, self.ring, note_wfd, credit_rfd,
+                        is_fileinput, partial, decoder)
+        os.close(note_wfd)
+        os.close(credit_rfd)
+        self.note_fd = note_rfd
+        self.credit_fd = credit_wfd
+        self.tail = 0
+        self.available = 0
+        self.file_pos = 0
+        self.is_eof = False
+    def read_notes(self):
+        # Returns the number of input bytes processed and whether an
+        # emergency stop was seen
+        data = os.read(self.note_fd, NOTE.size * 256)
+        nbytes = 0
+        is_m112 = False
+        for i in range(0, len(data), NOTE.size):
+            kind, slots, count, self.file_pos = NOTE.unpack_from(data, i)
+            self.available += slots
+            nbytes += count
+            if kind == NOTE_M112:
+                is_m112 = True
+            elif kind == NOTE_EOF:
+                self.is_eof = True
+        return nbytes, is_m112
+    def read(self, count):
+        # Return up to 'count' records.  Each record is either a
+        # parse_move() style list or a string containing a G-Code line.
+        ring = self.ring
+        tail = self.tail
+        available = self.available
+        out = []
+        while count and available:
+            pos = tail * SLOT.size
+            values = SLOT.unpack_from(ring, pos)
+            rtype = values[0]
+            if rtype == REC_PAD:
+                used = values[1]
+            elif rtype == REC_LINE:
+                used = 1 + (values[1] + SLOT.size - 1) // SLOT.size
+                pos += SLOT.size
+                out.append(ring[pos:pos+values[1]])
+                count -= 1
+            else:
+                used = 1
+                move = [None, None, None, None, None]
+                for p in MOVE_PARAMS[rtype]:
+                    move[p] = values[p+2]
+                out.append(move)
+                count -= 1
+            tail = (tail + used) % RING_SLOTS
+            available -= used
+        if available != self.available:
+            os.write(self.credit_fd, CREDIT.pack(self.available - available))
+        self.tail = tail
+        self.available = available
+        return out
+    def close(self):
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+            os.waitpid(self.pid, 0)
+        except OSError:
+            pass
+        os.close(self.note_fd)
+        os.close(self.credit_fd)
@@ -0,0 +1,275 @@
+# Local job api served over a unix domain socket
+#
+# Copyright (C) 2016  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os, socket, errno, json, time, logging
+import jobqueue
+
+# Each request and response is a JSON object on a single line.  A
+# client stops being read while this many G-Code blocks are waiting to
+# be processed (the blocks themselves are held up by the toolhead when
+# the planner buffer is full).
+MAX_PENDING_SCRIPTS = 2
+MAX_SEND_BUFFER = 4 * 1024 * 1024
+MIN_STATUS_INTERVAL = 0.050
+MIN_POSITION_INTERVAL = 0.010
+MIN_SPEED_FACTOR, MAX_SPEED_FACTOR = 0.1, 10.
+
+class error(Exception):
+    pass
+
+class JobClient:
+    def __init__(self, server, sock):
+        self.server = server
+        self.reactor = server.reactor
+        self.gcode = server.printer.gcode
+        self.sock = sock
+        self.sock.setblocking(0)
+        self.fd_handle = self.reactor.register_fd(
+            self.sock.fileno(), self.process_received)
+        self.partial_input = ""
+        self.send_buffer = ""
+        self.pending_scripts = 0
+        self.status_interval = 0.
+        self.status_timer = self.reactor.register_timer(self.send_status)
+        self.position_interval = 0.
+        self.position_timer = self.reactor.register_timer(self.send_position)
+        self.flush_timer = self.reactor.register_timer(self.flush_handler)
+        self.methods = {
+            'gcode': self.cmd_gcode, 'status': self.cmd_status,
+            'subscribe': self.cmd_subscribe, 'position': self.cmd_position,
+            'subscribe_position': self.cmd_subscribe_position,
+            'emergency_stop': self.cmd_emergency_stop,
+            'feed_hold': self.cmd_feed_hold, 'resume': self.cmd_resume,
+            'speed_factor': self.cmd_speed_factor,
+            'queue_job': self.cmd_queue_job, 'jobs': self.cmd_jobs,
+            'cancel_job': self.cmd_cancel_job}
+    def close(self):
+        if self.sock is None:
+            return
+        if self.fd_handle is not None:
+            self.reactor.unregister_fd(self.fd_handle)
+            self.fd_handle = None
+        self.reactor.unregister_timer(self.status_timer)
+        self.reactor.unregister_timer(self.position_timer)
+        self.reactor.unregister_timer(self.flush_timer)
+        self.sock.close()
+        self.sock = None
+        self.server.remove_client(self)
+    # Input handling
+    def process_received(self, eventtime):
+        try:
+            data = self.sock.recv(65536)
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            data = ""
+        if not data:
+            self.close()
+            return
+        lines = data.split('\n')
+        lines[0] = self.partial_input + lines[0]
+        self.partial_input = lines.pop()
+        for line in lines:
+            if line.strip():
+                self.process_request(line)
+        if self.pending_scripts >= MAX_PENDING_SCRIPTS:
+            self.update_flow_control()
+    def process_request(self, line):
+        req_id = None
+        try:
+            req = json.loads(line)
+            if type(req) != dict:
+                raise error("Request must be a JSON object")
+            req_id = req.get('id')
+            method = self.methods.get(req.get('method'))
+            if method is None:
+                raise error("Unknown method '%s'" % (req.get('method'),))
+            params = req.get('params', {})
+            if type(params) != dict:
+                raise error("Request params must be a JSON object")
+            method(req_id, params)
+        except (ValueError, error, jobqueue.error), e:
+            self.send({'id': req_id, 'error': str(e)})
+    def update_flow_control(self):
+        if self.sock is None:
+            return
+        if self.pending_scripts >= MAX_PENDING_SCRIPTS:
+            if self.fd_handle is not None:
+                self.reactor.unregister_fd(self.fd_handle)
+                self.fd_handle = None
+        elif self.fd_handle is None:
+            self.fd_handle = self.reactor.register_fd(
+                self.sock.fileno(), self.process_received)
+    # Output handling
+    def send(self, msg):
+        if self.sock is None:
+            return
+        self.send_buffer += json.dumps(msg, separators=(',', ':')) + "\n"
+        self.flush()
+    def flush(self):
+        while self.send_buffer:
+            try:
+                sent = self.sock.send(self.send_buffer)
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                self.close()
+                return
+            self.send_buffer = self.send_buffer[sent:]
+        if not self.send_buffer:
+            return
+        if len(self.send_buffer) > MAX_SEND_BUFFER:
+            logging.info("Job api client not reading responses - closing")
+            self.close()
+            return
+        self.reactor.update_timer(self.flush_timer, self.reactor.NOW)
+    def flush_handler(self, eventtime):
+        self.flush()
+        if self.send_buffer:
+            return eventtime + 0.050
+        return self.reactor.NEVER
+    # Methods
+    def cmd_gcode(self, req_id, params):
+        script = params.get('script')
+        if not isinstance(script, basestring):
+            raise error("gcode requires a 'script' parameter")
+        output = []
+        def done_callback(count):
+            self.pending_scripts -= 1
+            self.send({'id': req_id,
+                       'result': {'lines': count, 'output': output}})
+            self.update_flow_control()
+        self.pending_scripts += 1
+        self.gcode.queue_script(str(script).split('\n'), output.append,
+                                done_callback)
+    def cmd_status(self, req_id, params):
+        self.send({'id': req_id,
+                   'result': self.server.get_status(time.time())})
+    def get_interval(self, params, min_interval):
+        try:
+            interval = float(params.get('interval', 1.))
+        except (TypeError, ValueError):
+            raise error("Invalid subscribe interval")
+        if interval > 0.:
+            return max(interval, min_interval), self.reactor.NOW
+        return interval, self.reactor.NEVER
+    def cmd_subscribe(self, req_id, params):
+        interval, waketime = self.get_interval(params, MIN_STATUS_INTERVAL)
+        self.status_interval = interval
+        self.send({'id': req_id, 'result': {'interval': interval}})
+        self.reactor.update_timer(self.status_timer, waketime)
+    def cmd_position(self, req_id, params):
+        eventtime = params.get('time')
+        if eventtime is None:
+            eventtime = time.time()
+        elif not isinstance(eventtime, (int, float)):
+            raise error("Invalid position time")
+        self.send({'id': req_id,
+                   'result': self.server.get_position(float(eventtime))})
+    def cmd_subscribe_position(self, req_id, params):
+        interval, waketime = self.get_interval(params, MIN_POSITION_INTERVAL)
+        self.position_interval = interval
+        self.send({'id': req_id, 'result': {'interval': interval}})
+        self.reactor.update_timer(self.position_timer, waketime)
+    def cmd_emergency_stop(self, req_id, params):
+        self.gcode.emergency_stop(time.time())
+        self.send({'id': req_id, 'result': {}})
+    def cmd_feed_hold(self, req_id, params):
+        if not self.gcode.is_printer_ready:
+            raise error(self.server.printer.get_state_message())
+        self.server.get_toolhead().feed_hold()
+        self.send({'id': req_id, 'result': {}})
+    def cmd_resume(self, req_id, params):
+        self.server.get_toolhead().resume()
+        self.send({'id': req_id, 'result': {}})
+    def cmd_speed_factor(self, req_id, params):
+        factor = params.get('factor')
+        if (not isinstance(factor, (int, float))
+            or not MIN_SPEED_FACTOR <= factor <= MAX_SPEED_FACTOR):
+            raise error("speed_factor requires a 'factor' between %.1f"
+                        " and %.1f" % (MIN_SPEED_FACTOR, MAX_SPEED_FACTOR))
+        self.server.get_toolhead().set_speed_factor(float(factor))
+        self.send({'id': req_id, 'result': {'factor': float(factor)}})
+    def cmd_queue_job(self, req_id, params):
+        filename = params.get('filename')
+        if not isinstance(filename, basestring):
+            raise error("queue_job requires a 'filename' parameter")
+        job = self.server.job_queue.add_job(str(filename))
+        self.send({'id': req_id, 'result': {'job': job.job_id}})
+    def cmd_jobs(self, req_id, params):
+        self.send({'id': req_id,
+                   'result': {'jobs': self.server.job_queue.get_status()}})
+    def cmd_cancel_job(self, req_id, params):
+        self.server.job_queue.cancel_job(params.get('job'))
+        self.send({'id': req_id, 'result': {}})
+    def send_status(self, eventtime):
+        self.send({'status': self.server.get_status(eventtime)})
+        return eventtime + self.status_interval
+    def send_position(self, eventtime):
+        try:
+            self.send({'position': self.server.get_position(eventtime)})
+        except error:
+            pass
+        return eventtime + self.position_interval
+
+class JobAPIServer:
+    def __init__(self, printer, path):
+        self.printer = printer
+        self.reactor = printer.reactor
+        try:
+            os.unlink(path)
+        except os.error:
+            pass
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        self.sock.bind(path)
+        self.sock.listen(4)
+        self.fd_handle = self.reactor.register_fd(
+            self.sock.fileno(), self.accept)
+        self.clients = []
+        self.job_queue = jobqueue.JobQueue(printer)
+    def accept(self, eventtime):
+        try:
+            sock, addr = self.sock.accept()
+        except socket.error:
+            return
+        self.clients.append(JobClient(self, sock))
+    def remove_client(self, client):
+        if client in self.clients:
+            self.clients.remove(client)
+    def get_status(self, eventtime):
+        printer = self.printer
+        status = {'state': printer.get_state_message(),
+                  'gcode': printer.gcode.get_status(eventtime),
+                  'jobs': self.job_queue.get_status()}
+        toolhead = printer.objects.get('toolhead')
+        if toolhead is not None and printer.mcu is not None:
+            status['toolhead'] = toolhead.get_status(eventtime)
+        heaters = [('heater_bed', printer.objects.get('heater_bed'))]
+        extruder = printer.objects.get('extruder')
+        if extruder is not None:
+            heaters.append(('extruder', extruder.heater))
+        for name, heater in heaters:
+            if heater is not None:
+                temp, target = heater.get_temp()
+                status[name] = {'temperature': temp, 'target': target}
+        return status
+    def get_toolhead(self):
+        toolhead = self.printer.objects.get('toolhead')
+        if toolhead is None or self.printer.mcu is None:
+            raise error("Toolhead not available")
+        return toolhead
+    def get_position(self, eventtime):
+        # The toolhead position at the given time (computed from the
+        # planned moves - this doesn't query the micro-controller)
+        toolhead = self.get_toolhead()
+        pos, velocity = toolhead.get_live_position(eventtime)
+        return {'time': eventtime, 'position': pos, 'velocity': velocity}
+    def close(self):
+        for client in list(self.clients):
+            client.close()
+        self.job_queue.close()
+        self.reactor.unregister_fd(self.fd_handle)
+        self.sock.close()
@@ -0,0 +1,279 @@
+# Queue of G-Code print jobs with background pre-parsing
+#
+# Copyright (C) 2016  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os, signal, json, time, tempfile, shutil, hashlib, logging
+import gcodefile, gcodecache, gcodeindex, toolhead, homing, util
+
+# Number of jobs that are pre-parsed ahead of the printing job
+PREFETCH_JOBS = 1
+# Number of error messages kept for each job
+MAX_JOB_ERRORS = 10
+
+class error(Exception):
+    pass
+
+
+######################################################################
+# Pre-parse process
+######################################################################
+
+# Check that every move in a file stays within the printer limits.
+# The check uses the printer's kinematics (a copy owned by the
+# pre-parse process) with all axes treated as homed.  Positions are
+# tracked with the same rules as the G-Code parser.  An axis that is
+# homed by a G28 is placed at the position the kinematics home it to.
+class RangeChecker:
+    def __init__(self, toolhead):
+        self.toolhead = toolhead
+        self.kin = toolhead.kin
+        self.kin.set_homed([0, 1, 2])
+        self.homed_position = self.kin.get_homed_position()
+        self.state = gcodeindex.GCodeState()
+        self.lines = self.moves = 0
+    def check_lines(self, lines):
+        state = self.state
+        last_position = state.last_position
+        for line in lines:
+            self.lines += 1
+            start_pos = last_position[:3]
+            state.process_line(line)
+            end_pos = last_position[:3]
+            if None in end_pos:
+                for i in (0, 1, 2):
+                    if end_pos[i] is None:
+                        last_position[i] = self.homed_position[i]
+                continue
+            if end_pos == start_pos:
+                continue
+            self.moves += 1
+            epos = last_position[3]
+            move = toolhead.Move(self.toolhead, start_pos + [epos],
+                                 end_pos + [epos], state.speed,
+                                 self.toolhead.max_accel)
+            try:
+                self.kin.check_move(move)
+            except homing.EndstopError, e:
+                raise error("Line %d: %s" % (self.lines, e))
+
+def prefetch_job(filename, spool_name, toolhead):
+    starttime = time.time()
+    f = open(filename, 'rb')
+    try:
+        gfile = gcodefile.open_gcode_file(f.fileno())
+    finally:
+        f.close()
+    if gfile is None:
+        raise error("Unable to map G-Code file %s" % (filename,))
+    digest = hashlib.sha1(gfile.data).digest()
+    checker = RangeChecker(toolhead)
+    gcodecache.build_cache(gfile, spool_name, digest, checker.check_lines)
+    return {'digest': digest.encode('hex'), 'lines': checker.lines,
+            'moves': checker.moves, 'parse_time': time.time() - starttime}
+
+def prefetch_main(filename, spool_name, toolhead, result_fd):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        res = prefetch_job(filename, spool_name, toolhead)
+    except (EnvironmentError, error), e:
+        res = {'error': str(e)}
+    except:
+        logging.exception("Unhandled exception in job pre-parse")
+        res = {'error': "Internal error while parsing G-Code file"}
+    os.write(result_fd, json.dumps(res))
+    os._exit(0)
+
+
+######################################################################
+# Job queue
+######################################################################
+
+class PrintJob:
+    def __init__(self, job_id, filename):
+        self.job_id = job_id
+        self.filename = filename
+        self.state = 'queued'
+        self.spool_name = self.cache = None
+        self.lines = self.moves = 0
+        self.parse_time = 0.
+        self.start_time = self.end_time = None
+        self.errors = []
+    def note_output(self, msg):
+        if msg.startswith('!!'):
+            logging.info("Job %d: %s" % (self.job_id, msg))
+            if len(self.errors) < MAX_JOB_ERRORS:
+                self.errors.append(msg[2:].strip())
+    def get_status(self):
+        status = {'job': self.job_id, 'filename': self.filename,
+                  'state': self.state, 'lines': self.lines,
+                  'moves': self.moves, 'errors': self.errors}
+        if self.cache is not None:
+            status['progress'] = self.cache.get_progress()
+        return status
+
+# Jobs are printed in the order they were queued.  While a job prints
+# the following job is read and pre-parsed (tokenized, range checked,
+# and stored as a G-Code cache file) in a separate process so that the
+# next job starts without any host side warm-up.
+class JobQueue:
+    def __init__(self, printer):
+        self.printer = printer
+        self.reactor = printer.reactor
+        self.gcode = printer.gcode
+        self.spool_dir = tempfile.mkdtemp(prefix='klippy-spool-')
+        self.jobs = []
+        self.active_job = None
+        self.next_job_id = 1
+        self.prefetch_job = None
+        self.prefetch_pid = self.prefetch_fd = self.prefetch_handle = None
+        self.prefetch_result = ""
+        self.job_timer = self.reactor.register_timer(self.process_jobs)
+    def add_job(self, filename):
+        filename = os.path.abspath(filename)
+        if not os.path.isfile(filename):
+            raise error("G-Code file %s not found" % (filename,))
+        job = PrintJob(self.next_job_id, filename)
+        self.next_job_id += 1
+        self.jobs.append(job)
+        logging.info("Queued job %d: %s" % (job.job_id, filename))
+        self.reactor.update_timer(self.job_timer, self.reactor.NOW)
+        return job
+    def cancel_job(self, job_id):
+        for job in self.jobs:
+            if job.job_id == job_id:
+                break
+        else:
+            raise error("Unknown job %s" % (job_id,))
+        if job is self.prefetch_job:
+            self.stop_prefetch()
+        self.finish_job(job, 'cancelled')
+    def get_status(self):
+        return [job.get_status() for job in self.jobs]
+    def finish_job(self, job, state, msg=None):
+        logging.info("Job %d %s%s" % (
+            job.job_id, state, [": %s" % (msg,), ""][msg is None]))
+        job.state = state
+        if msg is not None:
+            job.errors.append(msg)
+        if job.cache is not None:
+            job.cache.close()
+            job.cache = None
+        if job.spool_name is not None:
+            try:
+                os.unlink(job.spool_name)
+            except os.error:
+                pass
+        if job is self.active_job:
+            self.active_job = None
+            job.end_time = time.time()
+        self.jobs.remove(job)
+        self.reactor.update_timer(self.job_timer, self.reactor.NOW)
+    # Pre-parsing
+    def check_prefetch(self):
+        if self.prefetch_job is not None:
+            return
+        toolhead = self.printer.objects.get('toolhead')
+        if toolhead is None:
+            return
+        ready = 0
+        for job in self.jobs:
+            if job.state == 'ready':
+                ready += 1
+            elif job.state == 'queued':
+                break
+        else:
+            return
+        if ready >= PREFETCH_JOBS:
+            return
+        job.state = 'parsing'
+        job.spool_name = os.path.join(self.spool_dir, "job%d.kgc" % (
+            job.job_id,))
+        rfd, wfd = os.pipe()
+        self.prefetch_pid = os.fork()
+        if not self.prefetch_pid:
+            util.setup_child_process([wfd])
+            prefetch_main(job.filename, job.spool_name, toolhead, wfd)
+        os.close(wfd)
+        self.prefetch_job = job
+        self.prefetch_fd = rfd
+        self.prefetch_result = ""
+        self.prefetch_handle = self.reactor.register_fd(
+            rfd, self.process_prefetch)
+    def stop_prefetch(self):
+        if self.prefetch_job is None:
+            return
+        try:
+            os.kill(self.prefetch_pid, signal.SIGTERM)
+        except OSError:
+            pass
+        self.finish_prefetch()
+    def finish_prefetch(self):
+        self.reactor.unregister_fd(self.prefetch_handle)
+        os.close(self.prefetch_fd)
+        try:
+            os.waitpid(self.prefetch_pid, 0)
+        except OSError:
+            pass
+        self.prefetch_job = None
+        self.prefetch_pid = self.prefetch_fd = self.prefetch_handle = None
+        self.reactor.update_timer(self.job_timer, self.reactor.NOW)
+    def process_prefetch(self, eventtime):
+        data = os.read(self.prefetch_fd, 4096)
+        if data:
+            self.prefetch_result += data
+            return
+        job = self.prefetch_job
+        self.finish_prefetch()
+        try:
+            res = json.loads(self.prefetch_result)
+        except ValueError:
+            res = {'error': "G-Code pre-parse process failed"}
+        if 'error' in res:
+            self.finish_job(job, 'error', res['error'])
+            return
+        try:
+            job.cache = gcodecache.GCodeCache(
+                job.spool_name, res['digest'].decode('hex'))
+        except (EnvironmentError, ValueError), e:
+            self.finish_job(job, 'error', str(e))
+            return
+        job.lines, job.moves = res['lines'], res['moves']
+        job.parse_time = res['parse_time']
+        job.state = 'ready'
+        logging.info("Job %d ready (%d lines, %d moves, parsed in %.3fs)" % (
+            job.job_id, job.lines, job.moves, job.parse_time))
+    # Printing
+    def process_jobs(self, eventtime):
+        if not self.jobs:
+            return self.reactor.NEVER
+        self.check_prefetch()
+        job = self.active_job
+        if not self.gcode.is_printer_ready:
+            if job is not None:
+                self.finish_job(job, 'error',
+                                self.printer.get_state_message())
+            return eventtime + 1.
+        if job is None:
+            job = self.jobs[0]
+            if job.state != 'ready':
+                # Still waiting for the job to be pre-parsed
+                return self.reactor.NEVER
+            logging.info("Starting job %d: %s" % (job.job_id, job.filename))
+            job.state = 'printing'
+            job.start_time = eventtime
+            self.active_job = job
+        if self.gcode.is_processing_data:
+            return eventtime + 0.100
+        records = job.cache.read(1024)
+        if not records:
+            self.finish_job(job, 'done')
+            return self.reactor.NOW
+        self.gcode.process_batch(records, job.note_output)
+        return self.reactor.NOW
+    def close(self):
+        self.stop_prefetch()
+        for job in list(self.jobs):
+            self.finish_job(job, 'cancelled')
+        self.reactor.unregister_timer(self.job_timer)
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
@@ -6,6 +6,8 @@
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import sys, optparse, ConfigParser, logging, time, threading
 import gcode, toolhead, util, mcu, fan, heater, extruder, reactor, queuelogger
+import gcodeindex
+import jobapi, sessionrec
 import msgproto
 
 message_startup = """
@@ -104,6 +106,8 @@ class Printer:
         self.need_dump_debug = False
         self.state_message = message_startup
         self.debugoutput = self.dictionary = None
+        self.api_server = None
+        self.recorder = None
         self.run_result = None
         self.fileconfig = None
         self.mcu = None
@@ -111,6 +115,20 @@ class Printer:
     def set_fileoutput(self, debugoutput, dictionary):
         self.debugoutput = debugoutput
         self.dictionary = dictionary
+    def set_gcode_cache(self, cache_dir):
+        self.gcode.set_cache_dir(cache_dir)
+    def set_gcode_resume(self, filename, line=None, layer=None):
+        self.gcode.set_resume(filename, line, layer)
+    def set_recorder(self, recorder):
+        self.recorder = recorder
+        self.gcode.set_recorder(recorder)
+        recorder.record_event(time.time(), "Starting Klippy")
+    def record_event(self, msg):
+        if self.recorder is not None:
+            self.recorder.record_event(time.time(), msg)
+            self.recorder.flush()
+    def set_api_server(self, path):
+        self.api_server = jobapi.JobAPIServer(self, path)
     def stats(self, eventtime):
         if self.need_dump_debug:
             # Call dump_debug here so it is executed in the main thread
@@ -124,6 +142,9 @@ class Printer:
         if self.mcu is not None:
             out.append(self.mcu.stats(eventtime))
         logging.info("Stats %.1f: %s" % (eventtime, ' '.join(out)))
+        if self.recorder is not None:
+            self.recorder.record_event(eventtime, "Stats " + ' '.join(out))
+            self.recorder.flush()
         return eventtime + 1.
     def load_config(self):
         self.fileconfig = ConfigParser.RawConfigParser()
@@ -148,7 +169,7 @@ class Printer:
     def build_config(self):
         for oname in sorted(self.objects.keys()):
             self.objects[oname].build_config()
-        self.gcode.build_config()
+        self.gcode.build_config(ConfigWrapper(self, 'printer'))
         self.mcu.build_config()
     def validate_config(self):
         valid_sections = dict([(s, 1) for s, o in self.all_config_options])
@@ -175,6 +196,7 @@ class Printer:
             self.validate_config()
             self.gcode.set_printer_ready(True)
             self.state_message = "Printer is ready"
+            self.record_event(self.state_message)
         except ConfigParser.Error, e:
             logging.exception("Config error")
             self.state_message = "%s%s" % (str(e), message_restart)
@@ -208,13 +230,18 @@ class Printer:
             self.need_dump_debug = True
         self.state_message = "Firmware shutdown: %s%s" % (
             msg, message_shutdown)
+        self.record_event("Firmware shutdown: %s" % (msg,))
         self.gcode.set_printer_ready(False)
     def note_mcu_error(self, msg):
         self.state_message = "%s%s" % (msg, message_restart)
+        self.record_event("MCU error: %s" % (msg,))
         self.gcode.set_printer_ready(False)
         self.gcode.motor_heater_off()
     def disconnect(self):
         try:
+            self.gcode.disconnect()
+            if self.api_server is not None:
+                self.api_server.close()
             if self.mcu is not None:
                 self.stats(time.time())
                 self.mcu.disconnect()
@@ -247,6 +274,16 @@ def main():
                     help="read commands from file instead of from tty port")
     opts.add_option("-I", "--input-tty", dest="inputtty", default='/tmp/printer',
                     help="input tty name (default is /tmp/printer)")
+    opts.add_option("-c", "--gcode-cache", dest="gcodecache",
+                    help="directory for caching parsed debuginput files")
+    opts.add_option("--resume-line", dest="resumeline", type="int",
+                    help="start the debuginput file at the given line")
+    opts.add_option("--resume-layer", dest="resumelayer", type="int",
+                    help="start the debuginput file at the given layer")
+    opts.add_option("-r", "--record", dest="recordfile",
+                    help="record G-Code input and timing events to file")
+    opts.add_option("-a", "--api-server", dest="apiserver",
+                    help="create a unix domain socket for the job api")
     opts.add_option("-l", "--logfile", dest="logfile",
                     help="write log to file instead of stderr")
     opts.add_option("-v", action="store_true", dest="verbose",
@@ -257,6 +294,9 @@ def main():
     if len(args) != 1:
         opts.error("Incorrect number of arguments")
     conffile = args[0]
+    if ((options.resumeline is not None or options.resumelayer is not None)
+        and not options.inputfile):
+        opts.error("Resuming requires a debuginput file")
 
     input_fd = debuginput = debugoutput = bglogger = None
 
@@ -278,6 +318,9 @@ def main():
     software_version = util.get_git_version()
     if debugoutput is None:
         logging.info("Git version: %s" % (repr(software_version),))
+    recorder = None
+    if options.recordfile:
+        recorder = sessionrec.SessionRecorder(options.recordfile)
 
     # Start firmware
     while 1:
@@ -286,6 +329,20 @@ def main():
         if debugoutput:
             proto_dict = read_dictionary(options.read_dictionary)
             printer.set_fileoutput(debugoutput, proto_dict)
+        if options.gcodecache:
+            printer.set_gcode_cache(options.gcodecache)
+        if options.resumeline is not None or options.resumelayer is not None:
+            try:
+                printer.set_gcode_resume(options.inputfile,
+                                         options.resumeline,
+                                         options.resumelayer)
+            except gcodeindex.error, e:
+                logging.error("Unable to resume G-Code file: %s" % (e,))
+                break
+        if recorder is not None:
+            printer.set_recorder(recorder)
+        if options.apiserver:
+            printer.set_api_server(options.apiserver)
         res = printer.run()
         if res == 'restart':
             printer.disconnect()
@@ -296,6 +353,8 @@ def main():
             printer.disconnect()
         break
 
+    if recorder is not None:
+        recorder.close()
     if bglogger is not None:
         bglogger.stop()
 
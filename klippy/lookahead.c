@@ -0,0 +1,214 @@
+// Toolhead move look-ahead
+//
+// Copyright (C) 2016  Kevin O'Connor <kevin@koconnor.net>
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+//
+// This is the backward pass of the look-ahead in toolhead.py
+// (MoveQueue.flush).  The results must be identical to those of a
+// full scan of the queue, so the calculations below are done in the
+// same order as the original python code.
+//
+// The backward pass results of a move only depend on the moves after
+// it.  Appending a move can only raise the reachable start velocity
+// of the queued moves, so once a move's start velocity is limited by
+// its junction_start_max it never changes again - and neither do the
+// results of the moves before it (other than the "corner max" value
+// that comes from a later move).  These results are cached so that a
+// flush only scans the moves after the last such move.
+
+#include <stdint.h> // uint64_t
+#include <stdio.h> // snprintf
+#include <stdlib.h> // malloc
+#include <string.h> // memmove
+#include "pyhelper.h" // errorf
+
+#define QUEUE_START_SIZE 256
+#define JUNCTION_INFO 5
+
+struct lookahead_move {
+    double junction_max, junction_delta, junction_start_max;
+};
+
+struct lookahead {
+    struct lookahead_move *moves;
+    double *move_info;
+    int head, count, size;
+    // The backward pass results (move_info) are fixed for the first
+    // 'frozen' queued moves.  The corner max of the moves from
+    // 'last_corner' onwards still depends on moves after 'frozen'.
+    int frozen, last_corner;
+    // Statistics
+    uint32_t flushes, max_scan, max_depth;
+    uint64_t added, scanned;
+};
+
+static inline double
+min_d(double a, double b)
+{
+    // Same result as python's min(a, b)
+    return b < a ? b : a;
+}
+
+// Allocate a new 'lookahead' object
+struct lookahead *
+lookahead_alloc(void)
+{
+    struct lookahead *la = malloc(sizeof(*la));
+    memset(la, 0, sizeof(*la));
+    la->last_corner = -1;
+    la->size = QUEUE_START_SIZE;
+    la->moves = malloc(la->size * sizeof(*la->moves));
+    la->move_info = malloc(la->size * JUNCTION_INFO * sizeof(double));
+    return la;
+}
+
+// Free memory associated with a 'lookahead' object
+void
+lookahead_free(struct lookahead *la)
+{
+    if (!la)
+        return;
+    free(la->moves);
+    free(la->move_info);
+    free(la);
+}
+
+// Remove all queued moves
+void
+lookahead_reset(struct lookahead *la)
+{
+    la->head = la->count = la->frozen = 0;
+    la->last_corner = -1;
+}
+
+// Add a move to the end of the queue
+void
+lookahead_add(struct lookahead *la, double junction_max
+              , double junction_delta, double junction_start_max)
+{
+    if (la->head + la->count >= la->size) {
+        if (la->head) {
+            // Move the queued moves (and their cached results) to the
+            // start of the arrays
+            memmove(la->moves, &la->moves[la->head]
+                    , la->count * sizeof(*la->moves));
+            memmove(la->move_info, &la->move_info[la->head * JUNCTION_INFO]
+                    , la->count * JUNCTION_INFO * sizeof(double));
+            la->head = 0;
+        }
+        if (la->count * 2 > la->size) {
+            int size = la->size * 2;
+            struct lookahead_move *moves = realloc(
+                la->moves, size * sizeof(*moves));
+            double *move_info = realloc(
+                la->move_info, size * JUNCTION_INFO * sizeof(double));
+            if (!moves || !move_info) {
+                errorf("lookahead queue expand failed (%d)", size);
+                exit(1);
+            }
+            la->moves = moves;
+            la->move_info = move_info;
+            la->size = size;
+        }
+    }
+    struct lookahead_move *m = &la->moves[la->head + la->count++];
+    m->junction_max = junction_max;
+    m->junction_delta = junction_delta;
+    m->junction_start_max = junction_start_max;
+    la->added++;
+    if (la->count > la->max_depth)
+        la->max_depth = la->count;
+}
+
+// Determine the junction speeds of the queued moves assuming the
+// toolhead comes to a complete stop after the last move.  The
+// junction speeds (start, cruise, end, corner min, and corner max) of
+// the moves that can be flushed are stored in *move_info and these
+// moves are removed from the queue.  Returns the number of flushed
+// moves.
+int
+lookahead_flush(struct lookahead *la, int lazy, double **move_info)
+{
+    double *all_info = &la->move_info[la->head * JUNCTION_INFO];
+    struct lookahead_move *moves = &la->moves[la->head];
+    int frozen = la->frozen, last_corner = la->last_corner, i;
+    int tail_corner = -1, last_limited = -1, new_corner = -1;
+    double next_junction_end = 0., junction_corner_min = 0.;
+    double junction_corner_max = 0.;
+    // Scan the moves whose results may have changed
+    for (i = la->count - 1; i >= frozen; i--) {
+        struct lookahead_move *m = &moves[i];
+        double reachable_start = next_junction_end + m->junction_delta;
+        double junction_start = min_d(m->junction_start_max
+                                      , reachable_start);
+        double junction_cruise = min_d(
+            (junction_start + reachable_start) * .5, m->junction_max);
+        double *info = &all_info[i * JUNCTION_INFO];
+        info[0] = junction_start;
+        info[1] = junction_cruise;
+        info[2] = next_junction_end;
+        info[3] = junction_corner_min;
+        info[4] = junction_corner_max;
+        if (reachable_start > junction_start) {
+            junction_corner_min = junction_start;
+            if (last_limited < 0)
+                last_limited = i;
+            if (junction_start + m->junction_delta > next_junction_end) {
+                junction_corner_max = junction_cruise;
+                if (tail_corner < 0)
+                    tail_corner = i;
+                if (i < last_limited && new_corner < 0)
+                    new_corner = i;
+            }
+        }
+        next_junction_end = junction_start;
+    }
+    int scan = la->count - frozen;
+    la->flushes++;
+    la->scanned += scan;
+    if (scan > la->max_scan)
+        la->max_scan = scan;
+
+    int flush_count = la->count;
+    if (lazy) {
+        // Only flush up to the last move that is at a "corner"
+        if (tail_corner >= 0)
+            flush_count = tail_corner;
+        else if (last_corner >= 0)
+            flush_count = last_corner;
+        else
+            flush_count = 0;
+    }
+    // Fill in the corner max of flushed moves that depends on the
+    // scanned moves
+    int end = frozen < flush_count ? frozen : flush_count;
+    for (i = last_corner > 0 ? last_corner : 0; i < end; i++)
+        all_info[i * JUNCTION_INFO + 4] = junction_corner_max;
+    // The moves before the last start limited move are now fixed
+    if (last_limited >= 0)
+        frozen = last_limited;
+    if (new_corner >= 0)
+        last_corner = new_corner;
+
+    // Remove the flushed moves from the queue
+    *move_info = all_info;
+    la->count -= flush_count;
+    la->head = la->count ? la->head + flush_count : 0;
+    la->frozen = frozen > flush_count ? frozen - flush_count : 0;
+    la->last_corner = (last_corner >= flush_count
+                       ? last_corner - flush_count : -1);
+    return flush_count;
+}
+
+// Report the queue depth and flush scan length statistics
+void
+lookahead_get_stats(struct lookahead *la, char *buf, int len)
+{
+    snprintf(buf, len, "lookahead_depth=%d lookahead_max_depth=%u"
+             " lookahead_moves=%llu lookahead_flushes=%u"
+             " lookahead_scanned=%llu lookahead_max_scan=%u"
+             , la->count, la->max_depth
+             , (unsigned long long)la->added, la->flushes
+             , (unsigned long long)la->scanned, la->max_scan);
+}
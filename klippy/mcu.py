@@ -400,7 +400,10 @@ class MCU:
             stats += " step_errors=%d" % (err,)
         return stats
     def force_shutdown(self):
-        self.send(self._emergency_stop_cmd.encode())
+        # Bypass all queued commands (and the serial output throttling)
+        self.serial.send_urgent(self._emergency_stop_cmd.encode())
+    def get_emergency_stop_times(self):
+        return self.serial.get_urgent_times()
     def clear_shutdown(self):
         logging.info("Sending clear_shutdown command")
         self.send(self._clear_shutdown_cmd.encode())
@@ -515,10 +518,14 @@ class MCU:
         return mcu_time - est_mcu_time
     def print_to_mcu_time(self, print_time):
         return print_time + self._print_start_time
+    def estimated_mcu_time(self, eventtime):
+        return self.serial.get_clock(eventtime) / self._mcu_freq
     def get_mcu_freq(self):
         return self._mcu_freq
     def get_last_clock(self):
         return self.serial.get_last_clock()
+    def get_serial_delay(self, eventtime):
+        return self.serial.get_queue_delay(eventtime)
     # Move command queuing
     def send(self, cmd, minclock=0, reqclock=0, cq=None):
         self.serial.send(cmd, minclock, reqclock, cq=cq)
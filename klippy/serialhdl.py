@@ -161,6 +161,16 @@ class SerialReader:
             cq = self.default_cmd_queue
         self.ffi_lib.serialqueue_send(
             self.serialqueue, cq, cmd, len(cmd), minclock, reqclock)
+    def send_urgent(self, cmd):
+        self.ffi_lib.serialqueue_send_urgent(self.serialqueue, cmd, len(cmd))
+    def get_urgent_times(self):
+        times = self.ffi_main.new('double[2]')
+        self.ffi_lib.serialqueue_get_urgent_times(self.serialqueue, times)
+        return times[0], times[1]
+    def get_queue_delay(self, eventtime):
+        # Time until the messages ready to be sent are written
+        idle_time = self.ffi_lib.serialqueue_get_idle_time(self.serialqueue)
+        return max(0., idle_time - eventtime)
     def encode_and_send(self, data, minclock, reqclock, cq):
         self.ffi_lib.serialqueue_encode_and_send(
             self.serialqueue, cq, data, len(data), minclock, reqclock)
@@ -63,11 +63,15 @@ pollreactor_setup(struct pollreactor *pr, int num_fds, int num_timers
     pr->next_timer = PR_NEVER;
     pr->fds = malloc(num_fds * sizeof(*pr->fds));
     memset(pr->fds, 0, num_fds * sizeof(*pr->fds));
+    // Unused entries must have a negative fd (poll() reports hangups
+    // even on fds that have no requested events)
+    int i;
+    for (i=0; i<num_fds; i++)
+        pr->fds[i].fd = -1;
     pr->fd_callbacks = malloc(num_fds * sizeof(*pr->fd_callbacks));
     memset(pr->fd_callbacks, 0, num_fds * sizeof(*pr->fd_callbacks));
     pr->timers = malloc(num_timers * sizeof(*pr->timers));
     memset(pr->timers, 0, num_timers * sizeof(*pr->timers));
-    int i;
     for (i=0; i<num_timers; i++)
         pr->timers[i].waketime = PR_NEVER;
 }
@@ -356,6 +360,9 @@ struct serialqueue {
     struct list_head pending_queues;
     int ready_bytes, stalled_bytes;
     uint64_t need_kick_clock;
+    // Urgent messages (sent ahead of all pending messages)
+    struct list_head urgent_queue;
+    double urgent_sent_time, urgent_done_time;
     // Received messages
     struct list_head receive_queue;
     // Debugging
@@ -592,6 +599,20 @@ build_and_send_command(struct serialqueue *sq, double eventtime)
     struct queue_message *out = message_alloc();
     out->len = MESSAGE_HEADER_SIZE;
 
+    // Urgent messages go at the start of the block
+    int urgent = 0;
+    while (!list_empty(&sq->urgent_queue)) {
+        struct queue_message *qm = list_first_entry(
+            &sq->urgent_queue, struct queue_message, node);
+        if (out->len + qm->len > sizeof(out->msg) - MESSAGE_TRAILER_SIZE)
+            break;
+        list_del(&qm->node);
+        memcpy(&out->msg[out->len], qm->msg, qm->len);
+        out->len += qm->len;
+        message_free(qm);
+        urgent = 1;
+    }
+
     while (sq->ready_bytes) {
         // Find highest priority message (message with lowest req_clock)
         uint64_t min_clock = MAX_CLOCK;
@@ -639,6 +660,10 @@ build_and_send_command(struct serialqueue *sq, double eventtime)
     sq->idle_time += out->len * sq->baud_adjust;
     out->sent_time = eventtime;
     out->receive_time = sq->idle_time;
+    if (urgent) {
+        sq->urgent_sent_time = get_time();
+        sq->urgent_done_time = sq->idle_time;
+    }
     if (list_empty(&sq->sent_queue))
         pollreactor_update_timer(&sq->pr, SQPT_RETRANSMIT
                                  , sq->idle_time + sq->rto);
@@ -652,13 +677,16 @@ build_and_send_command(struct serialqueue *sq, double eventtime)
 static double
 check_send_command(struct serialqueue *sq, double eventtime)
 {
-    if (eventtime < sq->idle_time - MAX_SERIAL_BUFFER)
+    int have_urgent = !list_empty(&sq->urgent_queue);
+    if (eventtime < sq->idle_time - MAX_SERIAL_BUFFER && !have_urgent)
         // Serial port already busy
         return sq->idle_time - MAX_SERIAL_BUFFER;
     if (sq->send_seq - sq->receive_seq >= MESSAGE_SEQ_MASK
         && sq->receive_seq != (uint64_t)-1)
         // Need an ack before more messages can be sent
         return PR_NEVER;
+    if (have_urgent)
+        return PR_NOW;
 
     // Check for stalled messages now ready
     double idletime = eventtime > sq->idle_time ? eventtime : sq->idle_time;
@@ -772,6 +800,7 @@ serialqueue_alloc(int serial_fd, int write_only)
     // Queues
     sq->need_kick_clock = MAX_CLOCK;
     list_init(&sq->pending_queues);
+    list_init(&sq->urgent_queue);
     list_init(&sq->sent_queue);
     list_init(&sq->receive_queue);
 
@@ -819,6 +848,7 @@ serialqueue_free(struct serialqueue *sq)
     if (!pollreactor_is_exit(&sq->pr))
         serialqueue_exit(sq);
     pthread_mutex_lock(&sq->lock);
+    message_queue_free(&sq->urgent_queue);
     message_queue_free(&sq->sent_queue);
     message_queue_free(&sq->receive_queue);
     message_queue_free(&sq->old_sent);
@@ -910,6 +940,22 @@ serialqueue_send(struct serialqueue *sq, struct command_queue *cq
     serialqueue_send_batch(sq, cq, &msgs);
 }
 
+// Send a message ahead of all pending messages and without waiting
+// for earlier data to drain from the serial port (eg, an emergency
+// stop).  The ack window is still honored.
+void
+serialqueue_send_urgent(struct serialqueue *sq, uint8_t *msg, int len)
+{
+    struct queue_message *qm = message_fill(msg, len);
+
+    pthread_mutex_lock(&sq->lock);
+    list_add_tail(&qm->node, &sq->urgent_queue);
+    sq->urgent_sent_time = sq->urgent_done_time = 0.;
+    pthread_mutex_unlock(&sq->lock);
+
+    kick_bg_thread(sq);
+}
+
 // Like serialqueue_send() but also builds the message to be sent
 void
 serialqueue_encode_and_send(struct serialqueue *sq, struct command_queue *cq
@@ -983,6 +1029,29 @@ serialqueue_set_clock_est(struct serialqueue *sq, double est_clock
     pthread_mutex_unlock(&sq->lock);
 }
 
+// Report the time the last urgent message was written to the serial
+// port and the estimated time its transmission completed (both are
+// zero until it is written)
+void
+serialqueue_get_urgent_times(struct serialqueue *sq, double *times)
+{
+    pthread_mutex_lock(&sq->lock);
+    times[0] = sq->urgent_sent_time;
+    times[1] = sq->urgent_done_time;
+    pthread_mutex_unlock(&sq->lock);
+}
+
+// Return the estimated time the serial port will have written all
+// messages that are ready to be sent
+double
+serialqueue_get_idle_time(struct serialqueue *sq)
+{
+    pthread_mutex_lock(&sq->lock);
+    double idle_time = sq->idle_time + sq->ready_bytes * sq->baud_adjust;
+    pthread_mutex_unlock(&sq->lock);
+    return idle_time;
+}
+
 // Return a string buffer containing statistics for the serial port
 void
 serialqueue_get_stats(struct serialqueue *sq, char *buf, int len)
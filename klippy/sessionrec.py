@@ -0,0 +1,65 @@
+# Recording of host G-Code input and timing events for later replay
+#
+# Copyright (C) 2016  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import struct
+
+SESSION_MAGIC = 'KSRC'
+SESSION_VERSION = 1
+HEADER = struct.Struct('<4sI')
+
+# Each record is a type byte, the reactor eventtime, and a length
+# followed by that many bytes of data.  REC_INPUT holds a chunk of raw
+# input as read from the G-Code pseudo-tty, REC_SCRIPT holds a block
+# of G-Code submitted by another interface (eg, the job api), and
+# REC_EVENT holds a text description of a host event (eg, state
+# changes and the periodic stats).
+RECORD = struct.Struct('<BdI')
+REC_INPUT, REC_SCRIPT, REC_EVENT = range(1, 4)
+
+class error(Exception):
+    pass
+
+class SessionRecorder:
+    def __init__(self, filename):
+        self.file = open(filename, 'wb')
+        self.file.write(HEADER.pack(SESSION_MAGIC, SESSION_VERSION))
+    def record(self, rtype, eventtime, data):
+        # Writes are buffered - they reach the file on flush() or once
+        # the file buffer fills
+        self.file.write(RECORD.pack(rtype, eventtime, len(data)) + data)
+    def record_input(self, eventtime, data):
+        self.record(REC_INPUT, eventtime, data)
+    def record_script(self, eventtime, lines):
+        self.record(REC_SCRIPT, eventtime, "\n".join(lines) + "\n")
+    def record_event(self, eventtime, msg):
+        self.record(REC_EVENT, eventtime, msg)
+    def flush(self):
+        self.file.flush()
+    def close(self):
+        self.file.close()
+
+# Return a list of (type, eventtime, data) records from a recording
+def read_session(filename):
+    f = open(filename, 'rb')
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    if len(data) < HEADER.size:
+        raise error("Truncated session recording")
+    magic, version = HEADER.unpack_from(data, 0)
+    if magic != SESSION_MAGIC or version != SESSION_VERSION:
+        raise error("Not a session recording (or unsupported version)")
+    out = []
+    pos = HEADER.size
+    while pos + RECORD.size <= len(data):
+        rtype, eventtime, length = RECORD.unpack_from(data, pos)
+        pos += RECORD.size
+        # A recording cut short by a crash may end with a partial record
+        if pos + length > len(data):
+            break
+        out.append((rtype, eventtime, data[pos:pos+length]))
+        pos += length
+    return out
@@ -3,8 +3,8 @@
 # Copyright (C) 2016  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import math, logging, time
-import cartesian, delta
+import math, logging, time, collections
+import cartesian, delta, chelper, homing
 
 EXTRUDE_DIFF_IGNORE = 1.02
 
@@ -13,12 +13,23 @@ EXTRUDE_DIFF_IGNORE = 1.02
 #   0.0 and 1.0)
 
 # Class to track each move request
-class Move:
+class Move(object):
+    # Moves are stored with a fixed set of fields (instead of a per
+    # instance dict) as many thousands of them may be queued.  This
+    # uses about a quarter of the memory per queued move.
+    __slots__ = (
+        'toolhead', 'start_pos', 'end_pos', 'accel', 'speed',
+        'timing_callbacks', 'do_calc_junction', 'is_kinematic_move',
+        'axes_d', 'move_d', 'extrude_r', 'junction_max', 'max_junction',
+        'junction_delta', 'junction_start_max',
+        'accel_r', 'cruise_r', 'decel_r', 'start_v', 'cruise_v', 'end_v',
+        'corner_min', 'corner_max', 'accel_t', 'cruise_t', 'decel_t')
     def __init__(self, toolhead, start_pos, end_pos, speed, accel):
         self.toolhead = toolhead
         self.start_pos = tuple(start_pos)
         self.end_pos = tuple(end_pos)
         self.accel = accel
+        self.timing_callbacks = []
         self.do_calc_junction = self.is_kinematic_move = True
         self.axes_d = axes_d = [end_pos[i] - start_pos[i] for i in (0, 1, 2, 3)]
         if axes_d[2]:
@@ -72,6 +83,11 @@ class Move:
             , prev_move.junction_start_max + prev_move.junction_delta)
     def process(self, junction_start, junction_cruise, junction_end
                 , junction_corner_min, junction_corner_max):
+        self.set_junction(junction_start, junction_cruise, junction_end
+                          , junction_corner_min, junction_corner_max)
+        self.toolhead.plan_move(self)
+    def set_junction(self, junction_start, junction_cruise, junction_end
+                     , junction_corner_min, junction_corner_max):
         # Determine accel, cruise, and decel portions of the move distance
         inv_junction_delta = 1. / self.junction_delta
         accel_r = (junction_cruise-junction_start) * inv_junction_delta
@@ -91,13 +107,18 @@ class Move:
         cruise_t = cruise_r * self.move_d / cruise_v
         decel_t = decel_r * self.move_d / ((end_v + cruise_v) * 0.5)
         self.accel_t, self.cruise_t, self.decel_t = accel_t, cruise_t, decel_t
+    def commit(self):
         # Generate step times for the move
         next_move_time = self.toolhead.get_next_move_time()
         if self.is_kinematic_move:
             self.toolhead.kin.move(next_move_time, self)
         if self.axes_d[3]:
             self.toolhead.extruder.move(next_move_time, self)
-        self.toolhead.update_move_time(accel_t + cruise_t + decel_t)
+        move_t = self.accel_t + self.cruise_t + self.decel_t
+        self.toolhead.update_move_time(move_t)
+        self.toolhead.move_history.add_move(next_move_time, self)
+        for callback in self.timing_callbacks:
+            callback(next_move_time + move_t)
 
 # Class to track a list of pending move requests and to facilitate
 # "look-ahead" across moves to reduce acceleration between moves.
@@ -105,54 +126,286 @@ class MoveQueue:
     def __init__(self):
         self.queue = []
         self.junction_flush = 0.
+        # The junction limits of the queued moves are also stored in C
+        # (lookahead.c) where the backward pass of the flush is done
+        ffi_main, self.ffi_lib = chelper.get_ffi()
+        self.lookahead = ffi_main.gc(self.ffi_lib.lookahead_alloc(),
+                                     self.ffi_lib.lookahead_free)
+        self.move_info = ffi_main.new('double **')
+        self.ffi_main = ffi_main
+        self.stats_buf = ffi_main.new('char[256]')
     def reset(self):
         del self.queue[:]
+        self.ffi_lib.lookahead_reset(self.lookahead)
+    def get_last(self):
+        if self.queue:
+            return self.queue[-1]
+        return None
     def flush(self, lazy=False):
-        flush_count = len(self.queue)
-        move_info = [None] * flush_count
-        # Traverse queue from last to first move and determine maximum
-        # junction speed assuming the robot comes to a complete stop
-        # after the last move.
-        next_junction_end = junction_corner_min = junction_corner_max = 0.
-        for i in range(flush_count-1, -1, -1):
-            move = self.queue[i]
-            reachable_start = next_junction_end + move.junction_delta
-            junction_start = min(move.junction_start_max, reachable_start)
-            junction_cruise = min((junction_start + reachable_start) * .5
-                                  , move.junction_max)
-            move_info[i] = (junction_start, junction_cruise, next_junction_end
-                            , junction_corner_min, junction_corner_max)
-            if reachable_start > junction_start:
-                junction_corner_min = junction_start
-                if junction_start + move.junction_delta > next_junction_end:
-                    junction_corner_max = junction_cruise
-                    if lazy:
-                        flush_count = i
-                        lazy = False
-            next_junction_end = junction_start
-        if lazy:
-            flush_count = 0
+        # Determine the junction speeds of the moves that can be
+        # flushed (see lookahead_flush() in lookahead.c)
+        flush_count = self.ffi_lib.lookahead_flush(
+            self.lookahead, lazy, self.move_info)
         # Generate step times for all moves ready to be flushed
+        info = self.move_info[0]
+        queue = self.queue
         for i in range(flush_count):
-            self.queue[i].process(*move_info[i])
+            j = i * 5
+            queue[i].process(info[j], info[j+1], info[j+2], info[j+3],
+                             info[j+4])
         # Remove processed moves from the queue
-        del self.queue[:flush_count]
-        if self.queue:
-            self.junction_flush = 2. * self.queue[-1].junction_max
+        del queue[:flush_count]
+        if queue:
+            self.junction_flush = 2. * queue[-1].junction_max
     def add_move(self, move):
         self.queue.append(move)
         if len(self.queue) == 1:
             self.junction_flush = 2. * move.junction_max
-            return
-        move.calc_junction(self.queue[-2])
-        self.junction_flush -= move.junction_delta
+        else:
+            move.calc_junction(self.queue[-2])
+            self.junction_flush -= move.junction_delta
+        self.ffi_lib.lookahead_add(
+            self.lookahead, move.junction_max, move.junction_delta,
+            move.junction_start_max)
         if self.junction_flush <= 0.:
             # There are enough queued moves to return to zero velocity
             # from the first move's maximum possible velocity, so at
             # least one move can be flushed.
             self.flush(lazy=True)
+    def stats(self):
+        self.ffi_lib.lookahead_get_stats(
+            self.lookahead, self.stats_buf, len(self.stats_buf))
+        return self.ffi_main.string(self.stats_buf)
+
+# Optional stage ahead of the look-ahead that merges runs of nearly
+# colinear moves (eg, the short segments of STL derived G-Code) into a
+# single move.  Moves are merged as long as the end of each merged
+# segment is within the tolerance of the combined move and the
+# segments have about the same extrude ratio.
+MERGE_MAX_MOVES = 64
+MERGE_EXTRUDE_DIFF = 0.01
+
+class MoveMerger:
+    def __init__(self, toolhead, tolerance):
+        self.toolhead = toolhead
+        self.tolerance = tolerance
+        self.moves = []
+        self.moves_in = self.moves_out = 0
+    def _can_merge(self, move):
+        moves = self.moves
+        first, last = moves[0], moves[-1]
+        if (len(moves) >= MERGE_MAX_MOVES or not move.is_kinematic_move
+            or not first.is_kinematic_move or move.speed != first.speed
+            or move.start_pos != last.end_pos):
+            return False
+        start_pos, end_pos = first.start_pos, move.end_pos
+        axes_d = [end_pos[i] - start_pos[i] for i in (0, 1, 2)]
+        move_d = math.sqrt(sum([d*d for d in axes_d]))
+        if not move_d:
+            return False
+        extrude_r = (end_pos[3] - start_pos[3]) / move_d
+        max_extrude_diff = abs(extrude_r) * MERGE_EXTRUDE_DIFF
+        if abs(move.extrude_r - extrude_r) > max_extrude_diff:
+            return False
+        # Check the distance of each segment end from the new move
+        inv_move_d = 1. / move_d
+        ux, uy, uz = [d * inv_move_d for d in axes_d]
+        max_dist2 = self.tolerance**2
+        last_t = 0.
+        for m in moves:
+            if abs(m.extrude_r - extrude_r) > max_extrude_diff:
+                return False
+            pos = m.end_pos
+            dx = pos[0] - start_pos[0]
+            dy = pos[1] - start_pos[1]
+            dz = pos[2] - start_pos[2]
+            t = dx*ux + dy*uy + dz*uz
+            if t <= last_t or dx*dx + dy*dy + dz*dz - t*t > max_dist2:
+                return False
+            last_t = t
+        return last_t < move_d
+    def add_move(self, move):
+        self.moves_in += 1
+        if self.moves and not self._can_merge(move):
+            self.flush()
+        self.moves.append(move)
+    def flush(self):
+        moves = self.moves
+        if not moves:
+            return
+        self.moves = []
+        if len(moves) > 1:
+            try:
+                moves = [self.toolhead._build_move(
+                    moves[0].start_pos, moves[-1].end_pos, moves[0].speed)]
+            except homing.EndstopError:
+                # Queue the moves unmerged (they were checked already)
+                pass
+        self.moves_out += len(moves)
+        move_queue = self.toolhead.move_queue
+        for move in moves:
+            move_queue.add_move(move)
+    def reset(self):
+        self.moves = []
+    def get_merge_ratio(self):
+        if not self.moves_out:
+            return 1.
+        return float(self.moves_in - len(self.moves)) / self.moves_out
 
+# Record of recently processed moves.  It is used to find the toolhead
+# position at a given time without querying the micro-controller.
+# Entries are stored by mcu time (print_time restarts whenever the
+# toolhead goes idle).
+class MoveHistory:
+    def __init__(self, mcu, size):
+        self.mcu = mcu
+        self.size = size
+        self.moves = [None] * size
+        self.count = 0
+    def add_move(self, print_time, move):
+        self.moves[self.count % self.size] = (
+            self.mcu.print_to_mcu_time(print_time), move.start_pos,
+            move.axes_d, move.move_d, move.accel_t, move.cruise_t,
+            move.decel_t, move.start_v, move.cruise_v, move.end_v)
+        self.count += 1
+    def set_position(self, mcu_time, pos):
+        # Note a change of position that isn't from a move (eg, homing)
+        self.moves[self.count % self.size] = (
+            mcu_time, tuple(pos), (0., 0., 0., 0.), 0., 0., 0., 0., 0., 0., 0.)
+        self.count += 1
+    def get_position(self, mcu_time):
+        # Find the last move that starts before mcu_time
+        size = self.size
+        moves = self.moves
+        low = max(0, self.count - size)
+        high = self.count
+        if mcu_time < moves[low % size][0]:
+            return list(moves[low % size][1]), 0.
+        while high - low > 1:
+            mid = (low + high) // 2
+            if moves[mid % size][0] <= mcu_time:
+                low = mid
+            else:
+                high = mid
+        (start_time, start_pos, axes_d, move_d, accel_t, cruise_t, decel_t,
+         start_v, cruise_v, end_v) = moves[low % size]
+        # Find the distance moved at the given time
+        move_t = mcu_time - start_time
+        if move_t >= accel_t + cruise_t + decel_t:
+            # Stopped after the move (the next move hasn't started)
+            dist, velocity = move_d, 0.
+        elif move_t < accel_t:
+            accel = (cruise_v - start_v) / accel_t
+            velocity = start_v + accel * move_t
+            dist = (start_v + velocity) * .5 * move_t
+        else:
+            dist = (start_v + cruise_v) * .5 * accel_t
+            move_t -= accel_t
+            if move_t < cruise_t:
+                velocity = cruise_v
+                dist += cruise_v * move_t
+            else:
+                dist += cruise_v * cruise_t
+                move_t -= cruise_t
+                decel = (cruise_v - end_v) / decel_t
+                velocity = cruise_v - decel * move_t
+                dist += (cruise_v + velocity) * .5 * move_t
+        if not move_d:
+            return list(start_pos), 0.
+        dist_r = dist / move_d
+        pos = [start_pos[i] + axes_d[i] * dist_r for i in (0, 1, 2, 3)]
+        return pos, velocity
+
+# Adjustment of buffer_time_low and buffer_time_high from the measured
+# host timing.  While printing, the time the reactor wakes up late,
+# the duration of look-ahead flushes, and the serial queue delay are
+# sampled.  Once a second buffer_time_low is set to cover these delays
+# and buffer_time_high is lowered if the host has little jitter (both
+# within their configured bounds).  Increases take effect right away,
+# decreases are applied gradually.
+BUFFER_SAMPLES = 256
+BUFFER_ADJUST_TIME = 1.000
+BUFFER_LOW_MARGIN = 2.
+BUFFER_HIGH_MARGIN = 20.
+BUFFER_DECAY = 0.1
+
+class BufferTimeControl:
+    def __init__(self, toolhead, config):
+        self.toolhead = toolhead
+        self.low_min = toolhead.buffer_time_low
+        self.low_max = config.getfloat('buffer_time_low_max', self.low_min)
+        self.high_max = toolhead.buffer_time_high
+        self.high_min = config.getfloat('buffer_time_high_min',
+                                        self.high_max)
+        if self.low_max < self.low_min:
+            raise config.error(
+                "buffer_time_low_max must not be less than buffer_time_low")
+        if self.high_min > self.high_max:
+            raise config.error(
+                "buffer_time_high_min must not exceed buffer_time_high")
+        if self.high_min < self.low_max:
+            raise config.error(
+                "buffer_time_high_min must not be less than"
+                " buffer_time_low_max")
+        self.lateness = collections.deque(maxlen=BUFFER_SAMPLES)
+        self.flush_times = collections.deque(maxlen=BUFFER_SAMPLES)
+        self.serial_delays = collections.deque(maxlen=BUFFER_SAMPLES)
+        self.next_adjust_time = 0.
+    def note_lateness(self, lateness):
+        if lateness >= 0.:
+            self.lateness.append(lateness)
+    def note_flush(self, flush_time):
+        self.flush_times.append(flush_time)
+    def _percentile(self, samples, p):
+        if not samples:
+            return 0.
+        samples = sorted(samples)
+        return samples[int(p * (len(samples) - 1))]
+    def _adjust(self, cur, target, low, high):
+        target = min(max(target, low), high)
+        if target < cur:
+            return cur + (target - cur) * BUFFER_DECAY
+        return target
+    def update(self, eventtime):
+        toolhead = self.toolhead
+        if toolhead.printer.mcu.is_fileoutput():
+            # The host timing doesn't reflect the printer in batch mode
+            return
+        self.serial_delays.append(
+            toolhead.printer.mcu.get_serial_delay(eventtime))
+        if eventtime < self.next_adjust_time:
+            return
+        self.next_adjust_time = eventtime + BUFFER_ADJUST_TIME
+        host_delay = (self._percentile(self.lateness, .99)
+                      + self._percentile(self.flush_times, .99)
+                      + max(self.serial_delays))
+        max_delay = (self._percentile(self.lateness, 1.)
+                     + self._percentile(self.flush_times, 1.)
+                     + max(self.serial_delays))
+        low = toolhead.buffer_time_low = self._adjust(
+            toolhead.buffer_time_low,
+            self.low_min + BUFFER_LOW_MARGIN * host_delay,
+            self.low_min, self.low_max)
+        toolhead.buffer_time_high = self._adjust(
+            toolhead.buffer_time_high, low + BUFFER_HIGH_MARGIN * max_delay,
+            self.high_min, self.high_max)
+    def stats(self):
+        lateness = self.lateness
+        return ("lateness_p50=%.4f lateness_p90=%.4f lateness_p99=%.4f"
+                " lateness_max=%.4f flush_p99=%.4f flush_max=%.4f"
+                " serial_delay_max=%.4f" % (
+                    self._percentile(lateness, .50),
+                    self._percentile(lateness, .90),
+                    self._percentile(lateness, .99),
+                    self._percentile(lateness, 1.),
+                    self._percentile(self.flush_times, .99),
+                    self._percentile(self.flush_times, 1.),
+                    max(self.serial_delays or [0.])))
+
+MOVE_HISTORY_SIZE = 4096
 STALL_TIME = 0.100
+MIN_FEED_HOLD_TIME = 0.350
+COMMIT_SPLIT_TIME = 0.100
 
 # Main code to track events (and their timing) on the printer toolhead
 class ToolHead:
@@ -167,10 +420,18 @@ class ToolHead:
         self.max_accel = config.getfloat('max_accel')
         self.junction_deviation = config.getfloat('junction_deviation', 0.02)
         self.move_queue = MoveQueue()
+        self.move_merger = None
+        merge_tolerance = config.getfloat('merge_tolerance', 0.)
+        if merge_tolerance < 0.:
+            raise config.error("merge_tolerance must not be negative")
+        if merge_tolerance:
+            self.move_merger = MoveMerger(self, merge_tolerance)
+        self.move_history = MoveHistory(printer.mcu, MOVE_HISTORY_SIZE)
         self.commanded_pos = [0., 0., 0., 0.]
         # Print time tracking
         self.buffer_time_high = config.getfloat('buffer_time_high', 5.000)
         self.buffer_time_low = config.getfloat('buffer_time_low', 0.150)
+        self.buffer_control = BufferTimeControl(self, config)
         self.move_flush_time = config.getfloat('move_flush_time', 0.050)
         self.motor_off_delay = config.getfloat('motor_off_time', 60.000)
         self.print_time = 0.
@@ -178,6 +439,19 @@ class ToolHead:
         self.print_time_stall = 0
         self.motor_off_time = self.reactor.NEVER
         self.flush_timer = self.reactor.register_timer(self._flush_handler)
+        self.flush_waketime = 0.
+        # Feed hold and speed factor tracking
+        self.feed_hold_time = config.getfloat('feed_hold_time', 0.)
+        if self.feed_hold_time and self.feed_hold_time < MIN_FEED_HOLD_TIME:
+            raise config.error("feed_hold_time must be at least %.3f" % (
+                MIN_FEED_HOLD_TIME,))
+        self.planned_moves = []
+        self.planned_time = self.commit_horizon = 0.
+        self.commit_end_v = 0.
+        self.commit_timer = self.reactor.register_timer(self._commit_handler)
+        self.is_held = False
+        self.held_moves = []
+        self.speed_factor = 1.
     def build_config(self):
         xy_halt = 0.005 * self.max_accel # XXX
         self.kin.set_max_jerk(xy_halt, self.max_speed, self.max_accel)
@@ -197,38 +471,65 @@ class ToolHead:
             self.reactor.update_timer(self.flush_timer, self.reactor.NOW)
         return self.print_time
     def get_last_move_time(self):
-        self.move_queue.flush()
+        self._flush_lookahead()
         return self.get_next_move_time()
+    def register_lookahead_callback(self, callback):
+        # Invoke callback with the print_time at the end of the last
+        # queued move once that move is processed (this does not
+        # require flushing the lookahead queue)
+        self._flush_merged()
+        last_move = self.move_queue.get_last()
+        if last_move is None and self.held_moves:
+            last_move = self.held_moves[-1]
+        if last_move is None and self.planned_moves:
+            last_move = self.planned_moves[-1]
+        if last_move is None:
+            callback(self.get_next_move_time())
+            return
+        last_move.timing_callbacks.append(callback)
     def reset_motor_off_time(self, eventtime):
         self.motor_off_time = eventtime + self.motor_off_delay
     def reset_print_time(self):
-        self.move_queue.flush()
+        self._flush_lookahead()
         self.printer.mcu.flush_moves(self.print_time)
         self.print_time = 0.
         self.need_check_stall = -1.
+        self.commit_end_v = 0.
+        self.flush_waketime = 0.
         self.reset_motor_off_time(time.time())
         self.reactor.update_timer(self.flush_timer, self.motor_off_time)
     def _check_stall(self):
         if not self.print_time:
             # XXX - find better way to flush initial move_queue items
-            if self.move_queue.queue:
+            if self.move_queue.queue or (
+                    self.move_merger is not None and self.move_merger.moves):
                 self.reactor.update_timer(self.flush_timer, time.time() + 0.100)
             return
         eventtime = time.time()
         while 1:
             buffer_time = self.printer.mcu.get_print_buffer_time(
-                eventtime, self.print_time)
+                eventtime, self.print_time + self.planned_time)
             stall_time = buffer_time - self.buffer_time_high
             if stall_time <= 0.:
                 break
-            eventtime = self.reactor.pause(eventtime + stall_time)
+            waketime = eventtime + stall_time
+            eventtime = self.reactor.pause(waketime)
+            self.buffer_control.note_lateness(eventtime - waketime)
             if not self.print_time:
                 return
-        self.need_check_stall = self.print_time - stall_time + 0.100
+        self.need_check_stall = (self.print_time + self.planned_time
+                                 - stall_time + 0.100)
     def _flush_handler(self, eventtime):
         try:
+            if self.flush_waketime:
+                self.buffer_control.note_lateness(
+                    eventtime - self.flush_waketime)
+                self.flush_waketime = 0.
             if not self.print_time:
-                self.move_queue.flush()
+                if self.is_held:
+                    # Keep the motors enabled during a feed hold
+                    return self.reactor.NEVER
+                self._flush_lookahead()
                 if not self.print_time:
                     if eventtime >= self.motor_off_time:
                         self.motor_off()
@@ -239,8 +540,14 @@ class ToolHead:
             buffer_time = self.printer.mcu.get_print_buffer_time(
                 eventtime, print_time)
             if buffer_time > self.buffer_time_low:
-                return eventtime + buffer_time - self.buffer_time_low
-            self.move_queue.flush()
+                self.buffer_control.update(eventtime)
+                self.flush_waketime = (eventtime + buffer_time
+                                       - self.buffer_time_low)
+                return self.flush_waketime
+            flush_start = time.time()
+            if not self.is_held:
+                self._flush_lookahead()
+            self.buffer_control.note_flush(time.time() - flush_start)
             if print_time != self.print_time:
                 self.print_time_stall += 1
                 self.dwell(self.buffer_time_low + STALL_TIME)
@@ -250,32 +557,263 @@ class ToolHead:
         except:
             logging.exception("Exception in flush_handler")
             self.force_shutdown()
-    def stats(self, eventtime):
+    # Planned moves
+    def plan_move(self, move):
+        # Invoked once the lookahead has set the velocities of a move.
+        # With a feed_hold_time the move is held in the planned list
+        # (where a feed hold may still replan it) until it starts
+        # within feed_hold_time of the current time.
+        if not self.feed_hold_time:
+            move.commit()
+            self.commit_end_v = move.end_v
+            return
+        self.planned_moves.append(move)
+        self.planned_time += move.accel_t + move.cruise_t + move.decel_t
+        if not self.print_time or self.print_time < self.commit_horizon:
+            self.reactor.update_timer(
+                self.commit_timer, self._commit_planned(time.time()))
+        elif len(self.planned_moves) == 1:
+            self.reactor.update_timer(self.commit_timer, self.reactor.NOW)
+    def _commit_planned(self, eventtime):
+        est_print_time = 0.
+        if self.print_time:
+            est_print_time = self.print_time - (
+                self.printer.mcu.get_print_buffer_time(
+                    eventtime, self.print_time))
+        self.commit_horizon = horizon = est_print_time + self.feed_hold_time
+        moves = self.planned_moves
+        count = 0
+        while count < len(moves) and self.print_time < horizon:
+            move = moves[count]
+            move_t = move.accel_t + move.cruise_t + move.decel_t
+            split_t = horizon + COMMIT_SPLIT_TIME - self.print_time
+            if move_t > split_t + COMMIT_SPLIT_TIME:
+                # Only commit the start of a long move
+                move, moves[count] = self._split_planned_move(
+                    move, split_t / move_t)
+                move_t = move.accel_t + move.cruise_t + move.decel_t
+            else:
+                count += 1
+            self.planned_time -= move_t
+            move.commit()
+            self.commit_end_v = move.end_v
+        del moves[:count]
+        if not moves:
+            self.planned_time = 0.
+            return self.reactor.NEVER
+        return eventtime + self.print_time - self.commit_horizon
+    def _commit_handler(self, eventtime):
+        try:
+            return self._commit_planned(eventtime)
+        except:
+            logging.exception("Exception in commit_handler")
+            self.force_shutdown()
+            return self.reactor.NEVER
+    def _flush_lookahead(self):
+        # Plan and commit every queued move
+        self._flush_merged()
+        self.move_queue.flush()
+        if not self.planned_moves:
+            return
+        for move in self.planned_moves:
+            move.commit()
+            self.commit_end_v = move.end_v
+        del self.planned_moves[:]
+        self.planned_time = 0.
+        self.reactor.update_timer(self.commit_timer, self.reactor.NEVER)
+    def _flush_merged(self):
+        if self.move_merger is not None:
+            self.move_merger.flush()
+    def _take_uncommitted(self):
+        self._flush_merged()
+        moves = self.planned_moves + self.move_queue.queue
+        del self.planned_moves[:]
+        self.planned_time = 0.
+        self.move_queue.reset()
+        self.reactor.update_timer(self.commit_timer, self.reactor.NEVER)
+        return moves
+    def _build_move(self, start_pos, end_pos, speed):
+        move = Move(self, start_pos, end_pos, self.max_speed, self.max_accel)
+        if not move.move_d:
+            return move
+        if move.is_kinematic_move:
+            self.kin.check_move(move)
+        if move.axes_d[3]:
+            self.extruder.check_move(move)
+        self._set_move_speed(move, speed)
+        return move
+    def _set_move_speed(self, move, speed):
+        # The speed limit found by the checks is kept so that the move
+        # can be replanned with a new speed factor
+        move.speed = speed
+        move.max_junction = move.junction_max
+        move.junction_max = min(move.max_junction,
+                                (speed * self.speed_factor)**2)
+    def _rebuild_moves(self, moves):
+        # Create the moves again with the current speed factor
+        out = []
+        for move in moves:
+            new_move = Move(self, move.start_pos, move.end_pos,
+                            math.sqrt(move.max_junction), move.accel)
+            self._set_move_speed(new_move, move.speed)
+            new_move.timing_callbacks = move.timing_callbacks
+            if out:
+                new_move.calc_junction(out[-1])
+            out.append(new_move)
+        return out
+    def _split_move(self, move, split_r):
+        mid_pos = [move.start_pos[i] + move.axes_d[i] * split_r
+                   for i in (0, 1, 2, 3)]
+        speed = math.sqrt(move.junction_max)
+        first = Move(self, move.start_pos, mid_pos, speed, move.accel)
+        second = Move(self, mid_pos, move.end_pos, speed, move.accel)
+        first.speed = second.speed = move.speed
+        first.max_junction = second.max_junction = move.max_junction
+        second.timing_callbacks = move.timing_callbacks
+        return first, second
+    def _split_planned_move(self, move, split_r):
+        first, second = self._split_move(move, split_r)
+        # Velocities (squared) at the start, the end, and the split
+        start, cruise = move.start_v**2, move.cruise_v**2
+        end, delta = move.end_v**2, move.junction_delta
+        split = min(start + delta * split_r, cruise,
+                    end + delta * (1. - split_r))
+        corner_min, corner_max = move.corner_min**2, move.corner_max**2
+        first.set_junction(start, min(cruise, start + first.junction_delta),
+                           split, corner_min, corner_max)
+        second.set_junction(split, min(cruise, end + second.junction_delta),
+                            end, corner_min, corner_max)
+        return first, second
+    def _slow_down(self, moves, hold):
+        # Decelerate from the velocity at the end of the committed
+        # moves (at the full acceleration of each move) until the
+        # velocity is zero (hold) or the lookahead can continue from
+        # it.  The velocities stay at or below those of the original
+        # plan, so the original junction limits still hold.  Returns
+        # the remaining (unplanned) moves.
+        junction = self.commit_end_v**2
+        reachable = [0.] * len(moves)
+        next_junction_end = 0.
+        for i in range(len(moves)-1, -1, -1):
+            move = moves[i]
+            reachable[i] = next_junction_end + move.junction_delta
+            next_junction_end = min(move.junction_start_max, reachable[i])
+        for i, move in enumerate(moves):
+            if hold:
+                cruise, reachable_start = 0., junction
+            else:
+                cruise, reachable_start = move.junction_max, reachable[i]
+            if junction <= cruise and junction <= reachable_start:
+                move.junction_start_max = junction
+                return moves[i:]
+            split_r = (junction - cruise) / move.junction_delta
+            if junction <= reachable_start and split_r < 1.:
+                # Reach the new velocity part way through the move
+                first, second = self._split_move(move, split_r)
+                if second.move_d:
+                    if first.move_d:
+                        first.process(junction, junction, max(
+                            0., junction - first.junction_delta), 0., 0.)
+                    second.junction_start_max = cruise
+                    return [second] + moves[i+1:]
+            junction_end = max(0., junction - move.junction_delta)
+            move.process(junction, junction, junction_end, 0., 0.)
+            junction = junction_end
+        return []
+    def feed_hold(self):
+        # Bring the toolhead to a stop as soon as possible and keep
+        # the moves after the stop until resume()
+        if self.is_held:
+            return
+        self.is_held = True
+        self.held_moves = self._slow_down(self._take_uncommitted(), True)
+        logging.info("Feed hold (%d moves held)" % (len(self.held_moves),))
+    def resume(self):
+        if not self.is_held:
+            return
+        self.is_held = False
+        moves = self._rebuild_moves(self.held_moves)
+        self.held_moves = []
+        for move in moves:
+            self.move_queue.add_move(move)
+        logging.info("Resume from feed hold")
+        self.reset_motor_off_time(time.time())
+        self.reactor.update_timer(self.flush_timer, self.reactor.NOW)
+    def wait_feed_hold(self):
+        eventtime = time.time()
+        while self.is_held:
+            eventtime = self.reactor.pause(eventtime + 0.100)
+    def set_speed_factor(self, speed_factor):
+        # Change the speed of the moves that have not been committed
+        self.speed_factor = speed_factor
+        if self.is_held:
+            return
+        moves = self._take_uncommitted()
+        if not moves:
+            return
+        for move in self._slow_down(self._rebuild_moves(moves), False):
+            self.move_queue.add_move(move)
+        if not self.print_time:
+            self.reactor.update_timer(self.flush_timer, self.reactor.NOW)
+    def get_status(self, eventtime):
         buffer_time = 0.
         if self.print_time:
             buffer_time = self.printer.mcu.get_print_buffer_time(
                 eventtime, self.print_time)
-        return "print_time=%.3f buffer_time=%.3f print_time_stall=%d" % (
-            self.print_time, buffer_time, self.print_time_stall)
+        return {'print_time': self.print_time, 'buffer_time': buffer_time,
+                'buffer_time_low': self.buffer_time_low,
+                'buffer_time_high': self.buffer_time_high,
+                'print_time_stall': self.print_time_stall,
+                'move_queue': len(self.move_queue.queue),
+                'planned_moves': len(self.planned_moves),
+                'feed_hold': self.is_held, 'speed_factor': self.speed_factor,
+                'live_position': self.get_live_position(eventtime)[0]}
+    def stats(self, eventtime):
+        status = self.get_status(eventtime)
+        res = "print_time=%.3f buffer_time=%.3f print_time_stall=%d %s" % (
+            status['print_time'], status['buffer_time'],
+            status['print_time_stall'], self.move_queue.stats())
+        res += " buffer_time_low=%.3f buffer_time_high=%.3f %s" % (
+            self.buffer_time_low, self.buffer_time_high,
+            self.buffer_control.stats())
+        if self.move_merger is not None:
+            res += " merge_ratio=%.3f" % (self.move_merger.get_merge_ratio(),)
+        return res
     # Movement commands
     def get_position(self):
         return list(self.commanded_pos)
+    def get_live_position(self, eventtime):
+        # Return the position (and velocity) of the toolhead at the
+        # given time from the history of planned moves
+        if not self.move_history.count:
+            return list(self.commanded_pos), 0.
+        mcu_time = self.printer.mcu.estimated_mcu_time(eventtime)
+        return self.move_history.get_position(mcu_time)
     def set_position(self, newpos):
-        self.move_queue.flush()
+        self._flush_lookahead()
         self.commanded_pos[:] = newpos
         self.kin.set_position(newpos)
+        # The new position takes effect after the queued moves (or now
+        # if the toolhead is idle - eg, after homing)
+        if self.print_time:
+            mcu_time = self.printer.mcu.print_to_mcu_time(self.print_time)
+        else:
+            mcu_time = self.printer.mcu.estimated_mcu_time(time.time())
+        self.move_history.set_position(mcu_time, newpos)
     def move(self, newpos, speed):
-        speed = min(speed, self.max_speed)
-        move = Move(self, self.commanded_pos, newpos, speed, self.max_accel)
+        if self.is_held:
+            # A command that issues several moves (eg, G2/G3) may be
+            # interrupted by a feed hold
+            self.wait_feed_hold()
+        move = self._build_move(self.commanded_pos, newpos, speed)
         if not move.move_d:
             return
-        if move.is_kinematic_move:
-            self.kin.check_move(move)
-        if move.axes_d[3]:
-            self.extruder.check_move(move)
         self.commanded_pos[:] = newpos
-        self.move_queue.add_move(move)
-        if self.print_time > self.need_check_stall:
+        if self.move_merger is not None:
+            self.move_merger.add_move(move)
+        else:
+            self.move_queue.add_move(move)
+        if self.print_time + self.planned_time > self.need_check_stall:
             self._check_stall()
     def home(self, homing_state):
         self.kin.home(homing_state)
@@ -291,7 +829,7 @@ class ToolHead:
         self.dwell(STALL_TIME)
         logging.debug('; Max time of %f' % (last_move_time,))
     def wait_moves(self):
-        self.move_queue.flush()
+        self._flush_lookahead()
         eventtime = time.time()
         while self.print_time:
             eventtime = self.reactor.pause(eventtime + 0.100)
@@ -301,4 +839,10 @@ class ToolHead:
     def force_shutdown(self):
         self.printer.mcu.force_shutdown()
         self.move_queue.reset()
+        if self.move_merger is not None:
+            self.move_merger.reset()
+        del self.planned_moves[:]
+        self.planned_time = 0.
+        self.is_held = False
+        self.held_moves = []
         self.reset_print_time()
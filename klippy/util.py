@@ -37,6 +37,28 @@ def create_pty(ptyname):
     termios.tcsetattr(mfd, termios.TCSADRAIN, old)
     return mfd
 
+# Setup a forked child process.  The child must not keep the parent's
+# files (serial port, sockets, pseudo-ttys) open, so every descriptor
+# other than stdin/stdout/stderr and those in 'keep_fds' is closed.
+# The parent's logging thread does not run in the child, so messages
+# are logged to stderr.
+def setup_child_process(keep_fds):
+    keep = set([0, 1, 2] + list(keep_fds))
+    try:
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except OSError:
+        fds = range(os.sysconf('SC_OPEN_MAX'))
+    for fd in fds:
+        if fd not in keep:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.StreamHandler(sys.stderr))
+
 def get_git_version():
     # Obtain version info from "git" program
     gitdir = os.path.join(sys.path[0], '..', '.git')
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# Benchmark G-Code processing throughput using the klippy batch mode
+#
+# Copyright (C) 2016  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, subprocess, tempfile, resource, time, math
+import json, logging, ConfigParser
+
+KLIPPYDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         '..', 'klippy')
+CONFIGDIR = os.path.join(KLIPPYDIR, '..', 'config')
+DEFAULT_CONFIGS = ['example.cfg', 'example-delta.cfg']
+
+
+######################################################################
+# Synthetic workloads
+######################################################################
+
+# Extruder filament per mm of XY travel (kept below the default
+# max_extrude_cross_section of the example configs)
+EXTRUDE_RATE = 0.04
+HEAVY_EXTRUDE_RATE = 0.09
+
+class WorkloadWriter:
+    def __init__(self, kinematics):
+        if kinematics == 'delta':
+            self.center, self.radius, self.z = (0., 0.), 60., 10.
+        else:
+            self.center, self.radius, self.z = (100., 100.), 80., 0.3
+        self.out = ["G28", "G90", "M82", "G1 Z%.3f F3000" % (self.z,),
+                    "G92 E0"]
+        self.pos = (self.center[0], self.center[1])
+        self.e = 0.
+    def travel(self, x, y, speed):
+        self.out.append("G1 X%.3f Y%.3f F%d" % (x, y, speed))
+        self.pos = (x, y)
+    def extrude(self, x, y, rate, speed=None):
+        dist = math.hypot(x - self.pos[0], y - self.pos[1])
+        self.e += dist * rate
+        line = "G1 X%.3f Y%.3f E%.5f" % (x, y, self.e)
+        if speed is not None:
+            line += " F%d" % (speed,)
+        self.out.append(line)
+        self.pos = (x, y)
+    def retract(self, length):
+        self.e -= length
+        self.out.append("G1 E%.5f F2400" % (self.e,))
+    def point(self, angle, radius):
+        return (self.center[0] + math.cos(angle) * radius,
+                self.center[1] + math.sin(angle) * radius)
+
+# Dense tiny segments (eg, a finely tessellated curved perimeter)
+def gen_tiny(w, count):
+    radius = w.radius * .5
+    steps = int(2. * math.pi * radius / 0.1)
+    w.travel(*(w.point(0., radius) + (6000,)))
+    i = 0
+    while len(w.out) < count:
+        i += 1
+        x, y = w.point(2. * math.pi * i / steps, radius)
+        w.extrude(x, y, EXTRUDE_RATE, 3000 if i == 1 else None)
+
+# Long straight moves across the bed
+def gen_long(w, count):
+    i = 0
+    while len(w.out) < count:
+        i += 1
+        x, y = w.point(i * 2.4, w.radius)
+        w.travel(x, y, 12000)
+
+# Zig-zag infill with heavy extrusion and periodic retractions
+def gen_infill(w, count):
+    spacing = 0.5
+    lines = int(2. * w.radius * .6 / spacing)
+    half = w.radius * .6
+    i = 0
+    while len(w.out) < count:
+        y = w.center[1] - half + (i % lines) * spacing
+        xs = (w.center[0] - half, w.center[0] + half)
+        if i % 2:
+            xs = xs[::-1]
+        if not i % lines:
+            w.retract(1.)
+            w.travel(xs[0], y, 9000)
+            w.retract(-1.)
+        else:
+            w.extrude(xs[0], y, HEAVY_EXTRUDE_RATE)
+        w.extrude(xs[1], y, HEAVY_EXTRUDE_RATE, 4800)
+        i += 1
+
+# Short moves interleaved with heater, fan, and status commands
+MIXED_CMDS = ["M105", "M106 S128", "M104 S205", "M114", "M107",
+              "M140 S60", "M104 S200", "M106 S255"]
+def gen_mixed(w, count):
+    i = 0
+    while len(w.out) < count:
+        i += 1
+        x, y = w.point(i * 0.05, w.radius * (.3 + .2 * math.sin(i * .01)))
+        w.extrude(x, y, EXTRUDE_RATE, 3000)
+        if not i % 4:
+            w.out.append(MIXED_CMDS[(i // 4) % len(MIXED_CMDS)])
+        if not i % 500:
+            w.out.append("G92 E0")
+            w.e = 0.
+
+WORKLOADS = {'tiny': gen_tiny, 'long': gen_long, 'infill': gen_infill,
+             'mixed': gen_mixed}
+DEFAULT_WORKLOADS = ['tiny', 'long', 'infill', 'mixed']
+
+def get_kinematics(configfile):
+    fileconfig = ConfigParser.RawConfigParser()
+    fileconfig.read(configfile)
+    return fileconfig.get('printer', 'kinematics')
+
+def write_workload(workload, configfile, count, filename):
+    w = WorkloadWriter(get_kinematics(configfile))
+    WORKLOADS[workload](w, count)
+    f = open(filename, 'wb')
+    f.write("\n".join(w.out[:count]) + "\n")
+    f.close()
+    return min(count, len(w.out))
+
+
+######################################################################
+# Stage timing
+######################################################################
+
+# CPU time is attributed to the innermost instrumented function, so
+# each stage reports only the time not spent in a nested stage.
+class StageTimer:
+    def __init__(self):
+        self.stack = []
+        self.times = {}
+        self.calls = {}
+        self.start_cpu = self.start_wall = None
+        self.end_cpu = self.end_wall = None
+    def start(self):
+        if self.start_cpu is None:
+            self.start_cpu = time.clock()
+            self.start_wall = time.time()
+    def stop(self):
+        self.end_cpu = time.clock()
+        self.end_wall = time.time()
+    def wrap(self, cls, name, stage):
+        func = getattr(cls, name)
+        key = "%s.%s" % (cls.__name__, name)
+        self.times[stage] = 0.
+        self.calls[key] = 0
+        def wrapper(*args, **kwargs):
+            self.start()
+            self.calls[key] += 1
+            self.stack.append(0.)
+            starttime = time.clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.clock() - starttime
+                self.times[stage] += elapsed - self.stack.pop()
+                if self.stack:
+                    self.stack[-1] += elapsed
+        setattr(cls, name, wrapper)
+    def wrap_finish(self, cls, name):
+        func = getattr(cls, name)
+        def wrapper(*args, **kwargs):
+            self.stop()
+            return func(*args, **kwargs)
+        setattr(cls, name, wrapper)
+
+def instrument(timer):
+    import gcode, toolhead, cartesian, delta, extruder
+    for name in ['process_data', 'process_file', 'process_commands',
+                 'process_cache', 'process_worker']:
+        if hasattr(gcode.GCodeParser, name):
+            timer.wrap(gcode.GCodeParser, name, 'gcode')
+    timer.wrap(toolhead.ToolHead, 'move', 'toolhead')
+    timer.wrap(toolhead.MoveQueue, 'flush', 'lookahead')
+    timer.wrap(cartesian.CartKinematics, 'move', 'kinematics')
+    timer.wrap(delta.DeltaKinematics, 'move', 'kinematics')
+    timer.wrap(extruder.PrinterExtruder, 'move', 'kinematics')
+    timer.wrap_finish(gcode.GCodeParser, 'motor_heater_off')
+
+
+######################################################################
+# Benchmark runs
+######################################################################
+
+# Run a single benchmark in this process and report the results
+def run_single(dictfile, configfile, workload, count):
+    fd, gcodefile = tempfile.mkstemp(suffix='.gcode')
+    os.close(fd)
+    try:
+        lines = write_workload(workload, configfile, count, gcodefile)
+        sys.path.insert(0, KLIPPYDIR)
+        import klippy
+        timer = StageTimer()
+        instrument(timer)
+        logging.disable(logging.INFO)
+        sys.argv = ['klippy.py', configfile, '-i', gcodefile,
+                    '-o', os.devnull, '-d', dictfile]
+        klippy.main()
+    finally:
+        os.unlink(gcodefile)
+    if timer.end_cpu is None:
+        timer.stop()
+    wall = timer.end_wall - timer.start_wall
+    cpu = timer.end_cpu - timer.start_cpu
+    stages = dict(timer.times)
+    stages['other'] = max(0., cpu - sum(stages.values()))
+    moves = timer.calls['ToolHead.move']
+    res = {
+        'config': os.path.basename(configfile), 'workload': workload,
+        'lines': lines, 'moves': moves,
+        'wall_time': round(wall, 6), 'cpu_time': round(cpu, 6),
+        'lines_per_sec': round(lines / wall, 1),
+        'moves_per_sec': round(moves / wall, 1),
+        'stage_cpu_time': dict((k, round(v, 6))
+                               for k, v in stages.items()),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    sys.stdout.write(json.dumps(res, sort_keys=True) + "\n")
+
+def main():
+    usage = "%prog [options] <klipper.dict>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--config", dest="configs", action="append",
+                    help="printer config file (may be repeated)")
+    opts.add_option("-w", "--workload", dest="workloads", action="append",
+                    help="workload to run (%s)" % (
+                        ", ".join(sorted(WORKLOADS)),))
+    opts.add_option("-n", "--lines", dest="lines", type="int",
+                    default=20000, help="number of G-Code lines per run")
+    opts.add_option("-o", "--output", dest="output",
+                    help="append JSON results to file instead of stdout")
+    opts.add_option("--single", action="store_true",
+                    help="internal - run one benchmark in this process")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    dictfile = os.path.abspath(args[0])
+    configs = options.configs or [os.path.join(CONFIGDIR, c)
+                                  for c in DEFAULT_CONFIGS]
+    workloads = options.workloads or DEFAULT_WORKLOADS
+    for w in workloads:
+        if w not in WORKLOADS:
+            opts.error("Unknown workload '%s'" % (w,))
+    if options.single:
+        run_single(dictfile, os.path.abspath(configs[0]), workloads[0],
+                   options.lines)
+        return
+    # Run each benchmark in a separate process so that peak memory
+    # usage and module state are not shared between runs
+    out = sys.stdout
+    if options.output:
+        out = open(options.output, 'ab')
+    devnull = open(os.devnull, 'wb')
+    for configfile in configs:
+        for w in workloads:
+            cmd = [sys.executable, os.path.abspath(__file__), '--single',
+                   '-c', os.path.abspath(configfile), '-w', w,
+                   '-n', str(options.lines), dictfile]
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                    stderr=devnull)
+            res = proc.communicate()[0]
+            if proc.returncode or not res.strip():
+                sys.stderr.write("Benchmark %s %s failed\n" % (
+                    configfile, w))
+                continue
+            out.write(res)
+            out.flush()
+
+if __name__ == '__main__':
+    main()
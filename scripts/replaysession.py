@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# Replay a recorded klippy session in batch mode
+#
+# Copyright (C) 2016  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, subprocess, time
+
+KLIPPYDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         '..', 'klippy')
+sys.path.insert(0, KLIPPYDIR)
+import sessionrec
+
+# The recorded input is fed to klippy over a pipe (as if it were a
+# debuginput file) with the original spacing between reads divided by
+# the replay speed.  A write blocks while klippy is busy, just as a
+# G-Code sender would wait on a full serial buffer.
+def replay(records, proc, speed, show_events):
+    start_time = time.time()
+    first_time = None
+    sent = count = 0
+    for rtype, eventtime, data in records:
+        if first_time is None:
+            first_time = eventtime
+        if rtype == sessionrec.REC_EVENT:
+            if show_events:
+                sys.stdout.write("%.3f: %s\n" % (
+                    eventtime - first_time, data))
+            continue
+        if speed > 0.:
+            delay = (eventtime - first_time) / speed - (
+                time.time() - start_time)
+            if delay > 0.:
+                time.sleep(delay)
+        proc.stdin.write(data)
+        proc.stdin.flush()
+        sent += len(data)
+        count += 1
+    proc.stdin.close()
+    proc.wait()
+    return sent, count, time.time() - start_time
+
+def main():
+    usage = "%prog [options] <recording> <config file> <klipper.dict>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-s", "--speed", dest="speed", type="float",
+                    default=1., help="replay speed (0 for no delays)")
+    opts.add_option("-o", "--output", dest="output", default=os.devnull,
+                    help="write the serial output to file")
+    opts.add_option("-l", "--logfile", dest="logfile",
+                    help="write the klippy log to file")
+    opts.add_option("-p", "--profile", dest="profile",
+                    help="run klippy under cProfile and store stats to file")
+    opts.add_option("-e", "--events", action="store_true",
+                    help="show the recorded events while replaying")
+    options, args = opts.parse_args()
+    if len(args) != 3:
+        opts.error("Incorrect number of arguments")
+    recording, configfile, dictfile = args
+    try:
+        records = sessionrec.read_session(recording)
+    except (EnvironmentError, sessionrec.error), e:
+        opts.error("Unable to read recording: %s" % (e,))
+    cmd = [sys.executable]
+    if options.profile:
+        cmd += ['-m', 'cProfile', '-o', options.profile]
+    cmd += [os.path.join(KLIPPYDIR, 'klippy.py'), configfile,
+            '-i', '/dev/stdin', '-o', options.output, '-d', dictfile]
+    if options.logfile:
+        cmd += ['-l', options.logfile]
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    sent, count, duration = replay(records, proc, options.speed,
+                                   options.events)
+    recorded = 0.
+    if records:
+        recorded = records[-1][1] - records[0][1]
+    sys.stdout.write("Replayed %d reads (%d bytes) in %.3fs"
+                     " (recorded session %.3fs)\n" % (
+                         count, sent, duration, recorded))
+
+if __name__ == '__main__':
+    main()
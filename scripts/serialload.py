@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+# Predict serial bandwidth and mcu move queue load for a G-Code file
+#
+# Copyright (C) 2016  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, tempfile, logging, bisect, heapq
+
+KLIPPYDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         '..', 'klippy')
+sys.path.insert(0, KLIPPYDIR)
+
+# Flag periods that use more than this fraction of the serial link
+LINK_WARN = 0.80
+# Flag periods where a queue_step command may be sent less than this
+# many seconds before it must start (the host only requests
+# retransmits of commands this close to their deadline once)
+LEAD_WARN = 0.250
+
+
+######################################################################
+# Batch mode run
+######################################################################
+
+# Run the file through klippy in batch mode (in this process) and
+# gather the information needed to analyze the serial output
+class BatchRun:
+    def __init__(self):
+        self.printer = None
+        self.stepper_names = {}
+        self.line_times = []
+    def instrument(self):
+        import klippy, gcode, stepper
+        orig_build_config = klippy.Printer.build_config
+        def build_config(printer):
+            self.printer = printer
+            return orig_build_config(printer)
+        klippy.Printer.build_config = build_config
+        orig_stepper_build_config = stepper.PrinterStepper.build_config
+        def stepper_build_config(s):
+            orig_stepper_build_config(s)
+            self.stepper_names[s.mcu_stepper.get_oid()] = s.name
+        stepper.PrinterStepper.build_config = stepper_build_config
+        # Note the print time at which each G-Code move completes
+        orig_move = gcode.GCodeParser.move
+        line_times = self.line_times
+        def move(parser, move):
+            orig_move(parser, move)
+            line = parser.lines_processed
+            parser.toolhead.register_lookahead_callback(
+                lambda print_time: line_times.append((print_time, line)))
+        gcode.GCodeParser.move = move
+    def run(self, configfile, gcodefile, dictfile, outfile):
+        import klippy
+        self.instrument()
+        logging.disable(logging.INFO)
+        sys.argv = ['klippy.py', configfile, '-i', gcodefile,
+                    '-o', outfile, '-d', dictfile]
+        klippy.main()
+        self.line_times.sort()
+    def find_lines(self, start_time, end_time):
+        # Return the range of G-Code lines with moves that complete in
+        # the given print time range
+        times = self.line_times
+        pos = bisect.bisect_left(times, (start_time, 0))
+        end = bisect.bisect_left(times, (end_time, 0))
+        if pos >= end:
+            if pos >= len(times):
+                return None
+            end = pos + 1
+        lines = [l for t, l in times[pos:end]]
+        return min(lines), max(lines)
+
+
+######################################################################
+# Serial output analysis
+######################################################################
+
+class StepCommand:
+    def __init__(self, oid, req, start, end, count):
+        self.oid = oid
+        self.req = req
+        self.start = start
+        self.end = end
+        self.count = count
+
+# Walk the messages in the serial output file
+def read_messages(dictfile, serialfile):
+    import msgproto
+    mp = msgproto.MessageParser()
+    f = open(dictfile, 'rb')
+    mp.process_identify(f.read(), decompress=False)
+    f.close()
+    f = open(serialfile, 'rb')
+    data = f.read()
+    f.close()
+    packets = []
+    while data:
+        l = mp.check_packet(data)
+        if l <= 0:
+            if not l:
+                break
+            data = data[-l:]
+            continue
+        s = bytearray(data[:l])
+        data = data[l:]
+        msgs = []
+        pos = msgproto.MESSAGE_HEADER_SIZE
+        while pos < l - msgproto.MESSAGE_TRAILER_SIZE:
+            mid = mp.messages_by_id.get(s[pos], mp.unknown)
+            params, pos = mid.parse(s, pos)
+            msgs.append((mid.name, params))
+        packets.append((l, msgs))
+    return mp.get_constant_float('CLOCK_FREQ'), packets
+
+class LoadAnalysis:
+    def __init__(self, freq, bucket_time):
+        self.freq = freq
+        self.bucket_time = bucket_time
+        self.last_clock = 0
+        self.step_clocks = {}
+        self.endstops = {}
+        self.homing = {}
+        self.steps = []
+        self.bytes = {}
+        self.step_counts = {}
+    def get_clock(self, clock32):
+        # Extend a 32bit clock using the most recent clock seen
+        diff = (clock32 - self.last_clock) & 0xffffffff
+        if diff >= 0x80000000:
+            diff -= 0x100000000
+        return self.last_clock + diff
+    def add_steps(self, cmd):
+        # Spread the steps of a command over the buckets it covers
+        start = cmd.start / self.freq
+        end = cmd.end / self.freq
+        duration = max(end - start, 1. / self.freq)
+        bt = self.bucket_time
+        counts = self.step_counts.setdefault(cmd.oid, {})
+        b = int(start / bt)
+        while b * bt < end or b == int(start / bt):
+            overlap = min(end, (b + 1) * bt) - max(start, b * bt)
+            counts[b] = counts.get(b, 0.) + cmd.count * max(
+                overlap, 0.) / duration
+            b += 1
+    def note_step_dir(self, oid):
+        # A homing move runs in one direction until the endstop
+        # triggers, at which point the mcu discards its remaining
+        # steps and restarts the stepper clock at zero.  Batch mode
+        # can't tell when that happens, so the homing move ends at the
+        # stepper's next direction change (the host always sends one
+        # after homing).
+        if oid not in self.homing:
+            return
+        self.homing[oid] += 1
+        if self.homing[oid] > 1:
+            del self.homing[oid]
+            self.step_clocks[oid] = 0
+    def queue_step(self, params):
+        # Track the step clock the same way the host's stepcompress
+        # code does
+        oid = params['oid']
+        last = req = self.step_clocks.get(oid, 0)
+        count = params['count']
+        interval = params['interval']
+        if count == 1:
+            end = self.get_clock(last + interval)
+            if last + (1 << 27) < end:
+                req = end
+        else:
+            ticks = params['add'] * count * (count - 1) // 2
+            end = last + ((ticks + interval * count) & 0xffffffff)
+        self.step_clocks[oid] = end
+        start = min(last + interval, end)
+        if oid in self.homing:
+            # Homing moves are not part of the steady state load
+            return start
+        cmd = StepCommand(oid, req, start, end, count)
+        self.steps.append(cmd)
+        self.add_steps(cmd)
+        return start
+    def process(self, packets):
+        for size, msgs in packets:
+            packet_clock = None
+            for name, params in msgs:
+                clock = None
+                if name == 'config_end_stop':
+                    self.endstops[params['oid']] = params['stepper_oid']
+                elif name == 'end_stop_home':
+                    clock = self.get_clock(params['clock'])
+                    stepper_oid = self.endstops.get(params['oid'])
+                    if params['clock'] and stepper_oid is not None:
+                        self.homing[stepper_oid] = 0
+                elif name == 'reset_step_clock':
+                    clock = self.get_clock(params['clock'])
+                    self.step_clocks[params['oid']] = clock
+                elif name == 'set_next_step_dir':
+                    self.note_step_dir(params['oid'])
+                elif name == 'queue_step':
+                    clock = self.queue_step(params)
+                elif 'clock' in params:
+                    clock = self.get_clock(params['clock'])
+                if clock is not None:
+                    self.last_clock = max(self.last_clock, clock)
+                    if packet_clock is None or clock < packet_clock:
+                        packet_clock = clock
+            if packet_clock is None:
+                packet_clock = self.last_clock
+            b = int(packet_clock / self.freq / self.bucket_time)
+            self.bytes[b] = self.bytes.get(b, 0) + size
+    def get_queue_stats(self, move_count, buffer_time):
+        # The host only sends a queue_step once one of the mcu's
+        # move_count queue slots is free (a slot is freed when the mcu
+        # starts the command in it).  Find the time between the
+        # earliest possible transmit of each command and the time the
+        # mcu needs it (the "lead") and how many commands the host
+        # wants queued to stay buffer_time ahead.
+        freq = self.freq
+        bt = self.bucket_time
+        heap = [-1] * move_count
+        min_lead = {}
+        for cmd in self.steps:
+            next_avail = heapq.heapreplace(heap, cmd.req)
+            if next_avail < 0:
+                # Queue not yet full - the command may be sent at any time
+                continue
+            lead = (cmd.req - next_avail) / freq
+            b = int(cmd.start / freq / bt)
+            if lead < min_lead.get(b, 9999999.):
+                min_lead[b] = lead
+        starts = sorted(cmd.req for cmd in self.steps)
+        ends = sorted(cmd.end for cmd in self.steps)
+        demand = {}
+        for b in self.get_buckets():
+            t = b * bt * freq
+            demand[b] = (bisect.bisect_right(starts, t + buffer_time * freq)
+                         - bisect.bisect_right(ends, t))
+        return min_lead, demand
+    def get_buckets(self):
+        buckets = set(self.bytes)
+        for counts in self.step_counts.values():
+            buckets.update(counts)
+        return sorted(buckets)
+
+
+######################################################################
+# Report
+######################################################################
+
+def report(run, analysis, baud, move_count, buffer_time, verbose):
+    bt = analysis.bucket_time
+    link_bytes = baud / 10.
+    min_lead, demand = analysis.get_queue_stats(move_count, buffer_time)
+    oids = sorted(analysis.step_counts)
+    names = [run.stepper_names.get(oid, "oid%d" % (oid,)) for oid in oids]
+    out = sys.stdout
+    out.write("baud=%d (%.0f bytes/s) move_count=%d buffer_time_high=%.3f"
+              " bucket=%.3fs\n" % (baud, link_bytes, move_count,
+                                   buffer_time, bt))
+    out.write("%9s %9s %6s %9s %6s %s %s\n" % (
+        "time", "bytes/s", "link%", "min_lead", "queue",
+        " ".join(["%10s" % (n,) for n in names]), "flags"))
+    flagged = []
+    peak_rate = dict((oid, (0., 0.)) for oid in oids)
+    peak_bytes = (0., 0.)
+    for b in analysis.get_buckets():
+        t = b * bt
+        rate = analysis.bytes.get(b, 0) / bt
+        link = rate / link_bytes
+        lead = min_lead.get(b)
+        queue = demand.get(b, 0)
+        rates = []
+        for oid in oids:
+            r = analysis.step_counts[oid].get(b, 0.) / bt
+            rates.append(r)
+            if r > peak_rate[oid][0]:
+                peak_rate[oid] = (r, t)
+        if rate > peak_bytes[0]:
+            peak_bytes = (rate, t)
+        flags = []
+        if link > LINK_WARN:
+            flags.append("link")
+        if lead is not None and lead < LEAD_WARN:
+            flags.append("lead")
+        if flags:
+            flagged.append((t, flags))
+        if verbose or flags:
+            lead_desc = "-"
+            if lead is not None:
+                lead_desc = "%9.3f" % (lead,)
+            out.write("%9.3f %9.0f %5.1f%% %9s %6d %s %s\n" % (
+                t, rate, link * 100., lead_desc, queue,
+                " ".join(["%10.0f" % (r,) for r in rates]),
+                ",".join(flags)))
+    # Summary
+    total_bytes = sum(analysis.bytes.values())
+    buckets = analysis.get_buckets()
+    duration = 0.
+    if buckets:
+        duration = (buckets[-1] - buckets[0] + 1) * bt
+    out.write("\nTotal: %d bytes over %.3fs of print time"
+              " (average %.0f bytes/s, %.1f%% of link)\n" % (
+                  total_bytes, duration, total_bytes / max(duration, bt),
+                  total_bytes / max(duration, bt) / link_bytes * 100.))
+    out.write("Peak: %.0f bytes/s (%.1f%% of link) at %.3fs\n" % (
+        peak_bytes[0], peak_bytes[0] / link_bytes * 100., peak_bytes[1]))
+    for oid, name in zip(oids, names):
+        out.write("Peak step rate %s: %.0f steps/s at %.3fs\n" % (
+            name, peak_rate[oid][0], peak_rate[oid][1]))
+    if not flagged:
+        out.write("No sections flagged\n")
+        return
+    # Merge adjacent flagged buckets into sections of the file
+    out.write("Flagged sections:\n")
+    sections = []
+    for t, flags in flagged:
+        if sections and abs(sections[-1][1] - t) < bt * 1.5:
+            sections[-1][1] = t + bt
+            sections[-1][2].update(flags)
+        else:
+            sections.append([t, t + bt, set(flags)])
+    for start, end, flags in sections:
+        lines = run.find_lines(start, end)
+        desc = "unknown lines"
+        if lines is not None:
+            desc = "lines %d-%d" % lines
+        out.write("  %.3fs-%.3fs (%s): %s\n" % (
+            start, end, desc, ",".join(sorted(flags))))
+
+def main():
+    usage = "%prog [options] <config file> <gcode file> <klipper.dict>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-b", "--bucket", dest="bucket", type="float",
+                    default=0.5, help="report interval in seconds")
+    opts.add_option("--baud", dest="baud", type="int",
+                    help="serial baud rate (default is the config baud)")
+    opts.add_option("-m", "--move-count", dest="move_count", type="int",
+                    help="mcu move queue size (default from batch mode)")
+    opts.add_option("-v", action="store_true", dest="verbose",
+                    help="report every interval (not just flagged ones)")
+    options, args = opts.parse_args()
+    if len(args) != 3:
+        opts.error("Incorrect number of arguments")
+    if options.bucket <= 0.:
+        opts.error("Invalid report interval")
+    configfile, gcodefile, dictfile = [os.path.abspath(a) for a in args]
+    fd, serialfile = tempfile.mkstemp(suffix='.serial')
+    os.close(fd)
+    try:
+        run = BatchRun()
+        run.run(configfile, gcodefile, dictfile, serialfile)
+        freq, packets = read_messages(dictfile, serialfile)
+    finally:
+        os.unlink(serialfile)
+    if run.printer is None:
+        sys.stderr.write("Batch mode run failed\n")
+        sys.exit(1)
+    baud = options.baud or run.printer.mcu.serial.baud
+    move_count = options.move_count or 500
+    buffer_time = run.printer.objects['toolhead'].buffer_time_high
+    analysis = LoadAnalysis(freq, options.bucket)
+    analysis.process(packets)
+    report(run, analysis, baud, move_count, buffer_time, options.verbose)
+
+if __name__ == '__main__':
+    main()